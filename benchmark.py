@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark walker against a fake PHP app running on this machine.
+
+The app answers every url and sends a synthetic xdebug report to the
+collector, framed like the README's append files. Every scale walks its own
+urls file in a fresh process, options after -- are passed to walker:
+
+    python benchmark.py --scales 1000,100000,1000000 -- -c 50 --transport tcp
+"""
+
+from optparse import OptionParser
+import datetime
+import hashlib
+import random
+import resource
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+import zlib
+import os
+
+import ujson
+from gevent.monkey import patch_all
+from gevent.pywsgi import WSGIServer
+
+import walker.report
+from walker import cli
+from walker.collector import FRAME, FRAME_MAGIC, reuseport_listener
+from walker.pool import LENGTH, send_message, recv_message
+
+
+class FakeApp(object):
+    """WSGI app answering like PHP with the README's prepend and append files.
+
+    Requests with X-Walker: yes are covered by `files` of the source files,
+    `lines` lines each, picked by the url so every walk of a url reports the
+    same coverage. Reports go to the collector the request headers name, udp
+    reports are split in frames of `chunk` bytes.
+    """
+
+    def __init__(self, sources, files=10, lines=100, body=4096, chunk=8000):
+        self.sources = sources
+        self.files = min(files, len(sources))
+        self.lines = lines
+        self.body = '<html><body>%s</body></html>' % ('x' * body)
+        self.chunk = chunk
+        self.connections = {}
+
+    def coverage(self, url):
+        rnd = random.Random(int(hashlib.md5(url).hexdigest(), 16))
+        coverage = {}
+        for filename, count in rnd.sample(self.sources, self.files):
+            coverage[filename] = dict((str(line), 1) for line in rnd.sample(xrange(1, count + 1), min(self.lines, count)))
+        return coverage
+
+    def connect(self, transport, host, port):
+        if transport == 'unix':
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(host)
+        else:
+            sock = socket.create_connection((host, port))
+        return sock
+
+    def send(self, environ, payload):
+        transport = environ.get('HTTP_X_WALKER_TRANSPORT', 'udp')
+        host, port = environ['HTTP_X_WALKER_HOST'], int(environ.get('HTTP_X_WALKER_PORT') or 0)
+        if transport == 'udp':
+            id = random.randint(0, 0x7fffffff)
+            chunks = [payload[i:i + self.chunk] for i in xrange(0, len(payload), self.chunk)]
+            # a socket per report like fsockopen("udp://..."), its source port picks the collector
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                for index, chunk in enumerate(chunks):
+                    udp.sendto(FRAME.pack(FRAME_MAGIC, id, index, len(chunks)) + chunk, (host, port))
+            finally:
+                udp.close()
+            return
+
+        # persistent connections like pfsockopen, a new group is a new walk
+        key = (transport, host, port, environ.get('HTTP_X_WALKER_GROUP'))
+        if key not in self.connections:
+            for idle in self.connections.values():
+                for sock in idle:
+                    sock.close()
+            self.connections = {key: []}
+        idle = self.connections[key]
+        try:
+            sock = idle.pop() if idle else self.connect(transport, host, port)
+            sock.sendall(LENGTH.pack(len(payload)) + payload)
+        except socket.error:
+            return
+        idle.append(sock)
+
+    def __call__(self, environ, start_response):
+        query = environ['PATH_INFO'] + '?' + environ.get('QUERY_STRING', '')
+        if environ.get('HTTP_X_WALKER') == 'yes':
+            report = {
+                'group': environ.get('HTTP_X_WALKER_GROUP'),
+                'uri': query,
+                'server': environ.get('HTTP_HOST', environ['SERVER_NAME']),
+                'coverage': self.coverage(query),
+                'query': query,
+                'id': environ.get('HTTP_X_WALKER_ID'),
+            }
+            self.send(environ, zlib.compress(ujson.encode(report)))
+        start_response('200 OK', [('Content-Type', 'text/html'), ('Content-Length', str(len(self.body)))])
+        return [self.body]
+
+
+def serve_app(app, port, processes):
+    """Forks `processes` servers of `app` sharing `port`, returns their pids."""
+    pids = []
+    for i in xrange(processes):
+        listener = reuseport_listener(('127.0.0.1', port), socket.SOCK_STREAM, 1024)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                # udp report ids are random, forks must not repeat each other's
+                random.seed()
+                WSGIServer(listener, app, log=None).serve_forever()
+            finally:
+                os._exit(0)
+        listener.close()
+        pids.append(pid)
+    return pids
+
+
+def write_sources(directory, count, lines):
+    """PHP files for reports to cover, returns (filename, lines) of each."""
+    sources = []
+    for i in xrange(count):
+        filename = os.path.join(directory, 'module%d' % (i % 10), 'file%d.php' % i)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write('<?php\n')
+            for line in xrange(2, lines + 1):
+                f.write('$value%d = strlen("line %d") + %d; // %s\n' % (line, line, i, 'x' * (line % 40)))
+        sources.append((filename, lines))
+    return sources
+
+
+def write_urls(path, count, port):
+    with open(path, 'w') as f:
+        for i in xrange(count):
+            f.write('http://127.0.0.1:%d/page%d.php?id=%d\n' % (port, i % 20, i))
+
+
+def measure(urls, count, args, directory):
+    """Walks `urls` with walker options `args`, runs in a forked process."""
+    sys.stdout.flush()
+    log = open(os.path.join(directory, 'walk%d.log' % count), 'w')
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+
+    metrics = os.path.join(directory, 'metrics%d.json' % count)
+    options, inputs = cli.make_parser().parse_args(
+        ['-u', urls, '-o', os.path.join(directory, 'report%d.html' % count), '--no-rewrite',
+         '-g', 'benchmark%d' % count, '--metrics', metrics] + args)
+    options.inputs = inputs
+
+    timings = {}
+    generate_report = walker.report.generate_report
+
+    def timed_report(*args, **kwargs):
+        timings['walked'] = time.time()
+        try:
+            return generate_report(*args, **kwargs)
+        finally:
+            timings['reported'] = time.time()
+
+    walker.report.generate_report = timed_report
+    started = time.time()
+    try:
+        cli.walk(options)
+    except SystemExit:
+        return {'urls': count, 'error': "walker exited, see %s" % log.name}
+    if 'reported' not in timings:
+        return {'urls': count, 'error': "no report generated, see %s" % log.name}
+
+    stats = ujson.decode(open(metrics).read())
+    requests = sum(sum(pattern['codes'].values()) for pattern in stats['requests'].values())
+    errors = sum(pattern['errors'] for pattern in stats['requests'].values())
+    collector = stats['collector']
+    reports = collector.get('collector_completed_total', 0)
+    walked = timings['walked'] - started
+    return {
+        'urls': count,
+        'requests': requests,
+        'errors': errors,
+        'reports': reports,
+        'malformed': collector.get('collector_malformed_total', 0),
+        'loss_rate': float(max(requests - reports, 0)) / requests if requests else 0.0,
+        'walk_seconds': walked,
+        'requests_per_second': requests / walked,
+        'reports_per_second': reports / walked,
+        'report_bytes': collector.get('ingest_bytes_total', 0) / reports if reports else 0,
+        'report_seconds': timings['reported'] - timings['walked'],
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_children_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def run_scenario(urls, count, args, directory):
+    """Runs measure() in a fresh process so peak RSS is this scale's own."""
+    parent, child = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            parent.close()
+            try:
+                result = measure(urls, count, args, directory)
+            except Exception, e:
+                # measure() sent stderr to the scenario's log
+                traceback.print_exc()
+                result = {'urls': count, 'error': "walk crashed with %s: %s, see %s" % (
+                    e.__class__.__name__, e, os.path.join(directory, 'walk%d.log' % count))}
+            send_message(child, result)
+        finally:
+            sys.stdout.flush()
+            os._exit(0)
+    child.close()
+    rfile = parent.makefile('rb', -1)
+    try:
+        return recv_message(rfile) or {'urls': count, 'error': "walk crashed"}
+    finally:
+        rfile.close()
+        parent.close()
+        os.waitpid(pid, 0)
+
+
+def make_parser():
+    parser = OptionParser(usage="%prog [options] [-- WALKER OPTIONS]")
+    parser.add_option("--scales", dest="scales", help="comma separated numbers of urls to walk", default="1000,10000")
+    parser.add_option("--results", dest="results", help="save results to this JSON file", default="benchmark.json")
+    parser.add_option("--port", dest="port", help="port of the fake app", type="int", default=8100)
+    parser.add_option("--app-processes", dest="app_processes", help="processes serving the fake app", type="int", default=2)
+    parser.add_option("--files", dest="files", help="files covered by a report", type="int", default=10)
+    parser.add_option("--lines", dest="lines", help="lines covered of every file", type="int", default=100)
+    parser.add_option("--chunk", dest="chunk", help="max bytes of a udp report frame", type="int", default=8000)
+    parser.add_option("--body", dest="body", help="bytes in a response body", type="int", default=4096)
+    parser.add_option("--source-files", dest="source_files", help="PHP files reports cover", type="int", default=200)
+    parser.add_option("--source-lines", dest="source_lines", help="lines of every PHP file", type="int", default=500)
+    parser.add_option("--directory", dest="directory", help="keep sources, urls, logs and reports in this directory")
+    return parser
+
+
+def main():
+    patch_all()
+    options, args = make_parser().parse_args()
+    scales = [int(scale) for scale in options.scales.split(',')]
+    directory = options.directory or tempfile.mkdtemp(prefix='walker-benchmark')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    sources = write_sources(os.path.join(directory, 'src'), options.source_files, options.source_lines)
+    app = FakeApp(sources, options.files, options.lines, options.body, options.chunk)
+    pids = serve_app(app, options.port, options.app_processes)
+    results = {
+        'started': datetime.datetime.now().isoformat(),
+        'walker_args': args,
+        'app': dict((name, getattr(options, name)) for name in
+                    ('app_processes', 'files', 'lines', 'chunk', 'body', 'source_files', 'source_lines')),
+        'scenarios': [],
+    }
+    try:
+        for count in scales:
+            urls = os.path.join(directory, 'urls%d.txt' % count)
+            write_urls(urls, count, options.port)
+            print "Walking %d urls" % count
+            result = run_scenario(urls, count, args, directory)
+            results['scenarios'].append(result)
+            if 'error' in result:
+                print "  %s" % result['error']
+                continue
+            print "  %.0f requests/s, %.0f reports/s, %.2f%% lost, peak RSS %.1fMB, report %.2fs" % (
+                result['requests_per_second'], result['reports_per_second'], result['loss_rate'] * 100,
+                result['peak_rss_kb'] / 1024.0, result['report_seconds'])
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        if not options.directory:
+            shutil.rmtree(directory)
+
+    with open(options.results, 'w') as f:
+        f.write(ujson.encode(results, indent=2))
+    print "Results saved to %s" % options.results
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,7 @@ setup(
     author='Oleg Fedoseev',
     author_email='oleg.fedoseev@me.com',
     url='http://github.com/aryoh/walker/',
-    py_modules=['walker'],
+    packages=['walker'],
     license='http://www.apache.org/licenses/LICENSE-2.0',
     classifiers=[],
 )
\ No newline at end of file
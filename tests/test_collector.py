@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+import zlib
+
+import ujson
+
+from walker.collector import FRAME, FRAME_MAGIC, LEGACY_CHUNK, CoverageServer, decode_report
+
+
+class FrameServer(CoverageServer):
+    """Keeps reassembled payloads instead of decoding them."""
+
+    def __init__(self, *args, **kwargs):
+        super(FrameServer, self).__init__(*args, **kwargs)
+        self.payloads = []
+
+    def complete(self, data):
+        self.payloads.append(data)
+
+
+def frames(id, payload, size):
+    chunks = [payload[i:i + size] for i in xrange(0, len(payload), size)]
+    return [FRAME.pack(FRAME_MAGIC, id, index, len(chunks)) + chunk for index, chunk in enumerate(chunks)]
+
+
+A = ('10.0.0.1', 4000)
+B = ('10.0.0.2', 4000)
+
+
+class FramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FrameServer(('127.0.0.1', 0))
+
+    def handle(self, *datagrams):
+        for address, data in datagrams:
+            self.server.handle(data, address)
+
+    def test_single_frame(self):
+        self.handle((A, frames(1, 'report', 100)[0]))
+        self.assertEqual(self.server.payloads, ['report'])
+        self.assertFalse(self.server.pending)
+
+    def test_interleaved(self):
+        first, second, other = frames(1, 'a' * 25, 10), frames(2, 'b' * 15, 10), frames(1, 'c' * 30, 10)
+        # the same id from another sender is another report
+        self.handle((A, first[0]), (A, second[1]), (B, other[2]), (A, first[2]),
+                    (B, other[0]), (A, second[0]), (A, first[1]), (B, other[1]))
+        self.assertEqual(self.server.payloads, ['b' * 15, 'a' * 25, 'c' * 30])
+        self.assertFalse(self.server.pending)
+        self.assertEqual(self.server.pending_size, 0)
+
+    def test_duplicate(self):
+        chunks = frames(1, 'abcdefghijklmnopqrstuvwxy', 10)
+        self.handle((A, chunks[0]), (A, chunks[0]), (A, chunks[2]), (A, chunks[2]), (A, chunks[1]))
+        self.assertEqual(self.server.payloads, ['abcdefghijklmnopqrstuvwxy'])
+        self.assertEqual(self.server.pending_size, 0)
+
+    def test_expired(self):
+        chunks = frames(1, 'a' * 25, 10)
+        self.handle((A, chunks[0]), (A, chunks[1]))
+        self.server.expire(time.time() + self.server.timeout + 1)
+        self.assertEqual(self.server.stats['expired'], 1)
+        self.assertFalse(self.server.pending)
+        self.assertEqual(self.server.pending_size, 0)
+
+        # the rest of an expired report never completes it
+        self.handle((A, chunks[2]))
+        self.assertEqual(self.server.payloads, [])
+
+    def test_max_pending(self):
+        self.server.max_pending = 30
+        first, second = frames(1, 'a' * 25, 10), frames(2, 'b' * 25, 10)
+        self.handle((A, first[0]), (A, first[1]), (A, second[0]), (A, second[1]))
+        self.assertEqual(self.server.stats['dropped'], 1)
+        self.assertEqual(self.server.pending_size, 20)
+
+        # late chunks of the dropped report are ignored
+        self.handle((A, first[2]), (A, second[2]))
+        self.assertEqual(self.server.payloads, ['b' * 25])
+        self.assertFalse(self.server.pending)
+
+    def test_malformed_frames(self):
+        self.handle((A, FRAME.pack(FRAME_MAGIC, 1, 2, 2) + 'x'), (A, FRAME_MAGIC + 'x'))
+        self.assertEqual(self.server.stats['malformed'], 2)
+        self.assertEqual(self.server.payloads, [])
+
+    def test_unframed(self):
+        self.handle((A, 'x' * LEGACY_CHUNK), (A, 'tail'), (B, 'whole'))
+        self.assertEqual(self.server.payloads, ['x' * LEGACY_CHUNK + 'tail', 'whole'])
+
+
+class DecodeReportTest(unittest.TestCase):
+
+    def report(self, coverage):
+        return zlib.compress(ujson.encode({'server': 'example.com', 'query': '/a.php?id=1',
+                                           'coverage': coverage, 'id': 7}))
+
+    def test_decode(self):
+        query, files, id = decode_report(self.report({'/src/a.php': {'3': 1, '1': 1}}))
+        self.assertEqual(query, 'http://example.com/a.php?id=1')
+        self.assertEqual(files, [('/src/a.php', [1, 3])])
+        self.assertEqual(id, '7')
+
+    def test_bad_lines(self):
+        self.assertRaises(ValueError, decode_report, self.report({'/src/a.php': {'-5': 1}}))
+        self.assertRaises(ValueError, decode_report, self.report({'/src/a.php': {'0': 1}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import defaultdict
+
+from walker.index import CoverageIndex, decode_postings, decode_varints, encode_postings, encode_varints, \
+    write_index
+from walker.snapshot import Snapshot, write_snapshot
+from walker.store import CoverageStore
+
+
+def random_store(seed, urls=60, files=8):
+    rnd = random.Random(seed)
+    store = CoverageStore()
+    for url in xrange(urls):
+        for file in rnd.sample(xrange(files), rnd.randint(1, files)):
+            lines = rnd.sample(xrange(1, 200), rnd.randint(1, 30))
+            store.add('/src/module%d/file%d.php' % (file % 3, file), lines, 'http://a/page?id=%d' % url)
+    return store
+
+
+class VarintTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32 - 1]
+        self.assertEqual(list(decode_varints(encode_varints(values))), values)
+        ids = [0, 3, 4, 200, 70000, 70001]
+        self.assertEqual(list(decode_postings(encode_postings(ids))), ids)
+
+
+class CoverageIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='walker-test')
+        self.path = os.path.join(self.directory, 'a.snap')
+        write_snapshot(random_store(1), self.path)
+        self.snapshot = Snapshot(self.path)
+        write_index(self.snapshot, self.path + '.index')
+        self.index = CoverageIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        self.snapshot.close()
+        shutil.rmtree(self.directory)
+
+    def test_urls(self):
+        for filename in self.snapshot.keys():
+            queries = self.snapshot.queries(filename)
+            for line in xrange(0, 201):
+                self.assertEqual(sorted(self.index.urls(filename, line)), sorted(set(queries.get(line, []))))
+
+    def test_files(self):
+        expected = defaultdict(lambda: defaultdict(set))
+        for filename in self.snapshot.keys():
+            for line, queries in self.snapshot.queries(filename).items():
+                for query in queries:
+                    expected[query][filename].add(line)
+        self.assertEqual(len(expected), len(self.snapshot.url_bounds))
+        for query, files in expected.items():
+            lines = dict((filename, sorted(lines)) for filename, lines in files.items())
+            self.assertEqual(self.index.files(query), lines)
+
+    def test_missing(self):
+        self.assertEqual(self.index.files('http://a/page?id=1000'), {})
+        self.assertEqual(self.index.files(''), {})
+        self.assertEqual(self.index.urls('/src/missing.php', 1), [])
+
+    def test_file_suffix(self):
+        line = min(self.snapshot.queries('/src/module0/file3.php'))
+        self.assertTrue(self.index.urls('/src/module0/file3.php', line))
+        self.assertEqual(self.index.urls('module0/file3.php', line), self.index.urls('/src/module0/file3.php', line))
+        # only whole path components match
+        self.assertEqual(self.index.urls('le3.php', line), [])
+
+    def test_stale(self):
+        # a snapshot rewritten in place with the same urls and files
+        write_snapshot(random_store(2), self.path)
+        os.utime(self.path, (1, 1))
+        self.assertRaises(ValueError, CoverageIndex, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
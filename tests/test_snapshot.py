@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+from walker.snapshot import Snapshot, merge_snapshots, write_snapshot
+from walker.store import CoverageStore
+
+
+def make_store(reports, lines_only=False):
+    """CoverageStore of (query, filename, lines) reports."""
+    store = CoverageStore(lines_only)
+    for query, filename, lines in reports:
+        store.add(filename, lines, query)
+    return store
+
+
+def normalized(coverage):
+    """to_dict(queries=True) with queries sorted, they're kept in url id order."""
+    return dict((filename, dict((line, sorted(queries)) for line, queries in lines.items()))
+                for filename, lines in coverage.to_dict(queries=True).items())
+
+
+REPORTS = [
+    [('http://a/1', '/src/a.php', [1, 2, 3]), ('http://a/1', '/src/b.php', [10]),
+     ('http://a/2', '/src/a.php', [1, 2, 3]), ('http://a/3', '/src/a.php', [2, 5])],
+    [('http://a/2', '/src/b.php', [10, 11]), ('http://a/4', '/src/c.php', [7])],
+    [('http://a/5', '/src/a.php', [5, 6]), ('http://a/1', '/src/c.php', [7, 8])],
+]
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='walker-test')
+        self.snapshots = []
+
+    def tearDown(self):
+        for snapshot in self.snapshots:
+            snapshot.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, coverage, name):
+        path = os.path.join(self.directory, name)
+        write_snapshot(coverage, path)
+        return self.open(path)
+
+    def open(self, path):
+        snapshot = Snapshot(path)
+        self.snapshots.append(snapshot)
+        return snapshot
+
+    def test_round_trip(self):
+        store = make_store(REPORTS[0])
+        snapshot = self.write(store, 'a.snap')
+        self.assertEqual(snapshot.keys(), ['/src/a.php', '/src/b.php'])
+        self.assertEqual(snapshot['/src/a.php'], {1: 2, 2: 3, 3: 2, 5: 1})
+        self.assertEqual(snapshot.to_dict(), store.to_dict(queries=False))
+        self.assertEqual(normalized(snapshot), normalized(store))
+        # identical sets of lines are stored once
+        self.assertEqual(len(snapshot.file('/src/a.php').sets), 2)
+
+    def test_rewrite(self):
+        snapshot = self.write(make_store(REPORTS[0]), 'a.snap')
+        self.assertEqual(normalized(self.write(snapshot, 'b.snap')), normalized(snapshot))
+
+    def test_lines_only(self):
+        snapshot = self.write(make_store(REPORTS[0], lines_only=True), 'a.snap')
+        self.assertTrue(snapshot.lines_only)
+        self.assertEqual(len(snapshot.url_bounds), 0)
+        self.assertEqual(snapshot['/src/b.php'], {10: 1})
+
+    def test_empty_file(self):
+        snapshot = self.write({'/src/a.php': {}, '/src/b.php': {3: ['http://a/1', 'http://a/2']}}, 'a.snap')
+        self.assertEqual(snapshot.keys(), ['/src/a.php', '/src/b.php'])
+        self.assertEqual(snapshot['/src/a.php'], {})
+        self.assertEqual(snapshot.queries('/src/a.php'), {})
+        data = snapshot.file('/src/a.php')
+        self.assertEqual((len(data.lines), len(data.sets), len(data.urls)), (0, 0, 0))
+        self.assertEqual(snapshot['/src/b.php'], {3: 2})
+        self.assertEqual(normalized(snapshot)['/src/b.php'], {3: ['http://a/1', 'http://a/2']})
+
+    def test_empty_snapshot(self):
+        snapshot = self.write(CoverageStore(), 'a.snap')
+        self.assertEqual((len(snapshot), len(snapshot.url_bounds)), (0, 0))
+
+    def test_not_a_snapshot(self):
+        path = os.path.join(self.directory, 'a.snap')
+        with open(path, 'wb') as f:
+            f.write('not a snapshot at all, not even close')
+        self.assertRaises(ValueError, Snapshot, path)
+
+    def test_merge(self):
+        parts = [self.write(make_store(reports), 'part%d.snap' % i) for i, reports in enumerate(REPORTS)]
+        store = make_store(sum(REPORTS, []))
+        for order in itertools.permutations(parts):
+            path = os.path.join(self.directory, 'merged.snap')
+            self.assertEqual(merge_snapshots(list(order), path), 3)
+            merged = self.open(path)
+            self.assertEqual(merged.to_dict(), store.to_dict(queries=False))
+            self.assertEqual(normalized(merged), normalized(store))
+
+    def test_merge_grouping(self):
+        parts = [self.write(make_store(reports), 'part%d.snap' % i) for i, reports in enumerate(REPORTS)]
+        path = os.path.join(self.directory, 'first.snap')
+        merge_snapshots(parts[:2], path)
+        merged = os.path.join(self.directory, 'merged.snap')
+        merge_snapshots([parts[2], self.open(path)], merged)
+        self.assertEqual(normalized(self.open(merged)), normalized(make_store(sum(REPORTS, []))))
+
+
+if __name__ == '__main__':
+    unittest.main()
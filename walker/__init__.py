@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Walk urls and generate code coverage for PHP code.
+
+Importing the package or its modules has no side effects, gevent patches the
+standard library only when walks are run from the command line:
+
+    python -m walker -u urls.txt -o report.html
+
+report writes HTML reports, collector receives reports sent by PHP, walk and
+browser walk urls, store, snapshot and index keep collected coverage, metrics
+has metrics and profiles of walks and cli the commands.
+"""
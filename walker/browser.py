@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""HTTP client of the walk, with keep-alive connection pools."""
+
+import urllib2
+from urllib import urlencode
+import errno
+import time
+import zlib
+import socket
+import httplib
+import cookielib
+import gzip
+import hashlib
+from urllib2 import HTTPError
+from urlparse import urlparse, urljoin
+from StringIO import StringIO
+
+from gevent.lock import BoundedSemaphore
+
+
+# BadStatusLine of a connection closed before the status line, python
+# before 2.7.18 gives the line as ''.
+CLOSED_STATUS_LINE = "No status line received - the server has closed the connection"
+
+
+class NoneContext(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc, value, traceback):
+        return True
+
+
+class ResponseError(Exception):
+    pass
+
+
+class HttpResponse(object):
+    url = None
+    code = None
+    data = None
+    catch_response = False
+    allow_http_error = False
+    _trigger_success = None
+    _trigger_failure = None
+
+    def __init__(self, method, url, name, code, data, info, gzip, stream=None):
+        self.method = method
+        self.url = url
+        self._name = name
+        self.code = code
+        self.data = data
+        self._info = info
+        self._gzip = gzip
+        self._decoded = False
+        self.stream = stream
+
+    @property
+    def info(self):
+        return self._info()
+
+    @property
+    def size(self):
+        """Bytes of the body as received."""
+        if self.stream is not None:
+            return self.stream.size
+        return len(self._data)
+
+    def _get_data(self):
+        if self.stream is not None:
+            return None
+        if self._gzip and not self._decoded and self._info().get("Content-Encoding") == "gzip":
+            self._data = gzip.GzipFile(fileobj=StringIO(self._data)).read()
+            self._decoded = True
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+
+    def __enter__(self):
+        if not self.catch_response:
+            raise ResponseError("If using response in a with() statement you must use catch_response=True")
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        if exc:
+            if isinstance(value, ResponseError):
+                self._trigger_failure(value)
+            else:
+                raise value
+        else:
+            self._trigger_success()
+        return True
+
+    data = property(_get_data, _set_data)
+
+
+class BodyStream(object):
+    """Reads a response body in chunks without keeping it.
+
+    Counts bytes as received, `digest` names a hashlib algorithm to hash
+    the body with. With `decompress` a gzip body is inflated chunk by chunk
+    and the digest and `decoded` count are of the inflated body.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, digest=None, decompress=False):
+        self.size = 0
+        self.decoded = 0
+        self.hash = hashlib.new(digest) if digest else None
+        self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if decompress else None
+
+    def read(self, response):
+        while True:
+            chunk = response.read(self.chunk_size)
+            if not chunk:
+                break
+            self.size = self.size + len(chunk)
+            if self.inflater is not None:
+                chunk = self.inflater.decompress(chunk)
+            self.feed(chunk)
+        if self.inflater is not None:
+            self.feed(self.inflater.flush())
+        return self
+
+    def feed(self, chunk):
+        self.decoded = self.decoded + len(chunk)
+        if self.hash is not None:
+            self.hash.update(chunk)
+
+    def hexdigest(self):
+        return self.hash.hexdigest() if self.hash is not None else None
+
+
+class ConnectionPool(object):
+    """Persistent HTTP/1.1 connections to a single host.
+
+    At most `maxsize` connections are open at once; callers wait for a free
+    one. Connections idle for longer than `idle_timeout` are closed instead
+    of being reused.
+    """
+
+    def __init__(self, scheme, netloc, maxsize=10, idle_timeout=15.0, timeout=30.0):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle = []
+        self.slots = BoundedSemaphore(maxsize)
+
+    def connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def evict(self):
+        deadline = time.time() - self.idle_timeout
+        while self.idle and self.idle[0][1] < deadline:
+            conn, used = self.idle.pop(0)
+            conn.close()
+
+    def get(self):
+        """Returns (connection, reused) and takes a slot until put() is called."""
+        self.slots.acquire()
+        self.evict()
+        if self.idle:
+            conn, used = self.idle.pop()
+            return conn, True
+        return self.connect(), False
+
+    def put(self, conn, reusable=True):
+        if reusable:
+            self.idle.append((conn, time.time()))
+        else:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        while self.idle:
+            conn, used = self.idle.pop()
+            conn.close()
+
+
+class CookieResponse(object):
+    """Just enough of a urllib2 response for cookielib."""
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+
+class HttpBrowser(object):
+    max_redirects = 10
+
+    def __init__(self, base_url, gzip=False, pool_size=10, idle_timeout=15.0, timeout=30.0):
+        self.base_url = base_url
+        self.gzip = gzip
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.cookies = cookielib.CookieJar()
+        self.pools = {}
+
+    def pool(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in self.pools:
+            self.pools[key] = ConnectionPool(scheme, netloc, self.pool_size, self.idle_timeout, self.timeout)
+        return self.pools[key]
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+    def _send(self, method, url, data, headers, stream=None):
+        parts = urlparse(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        request = urllib2.Request(url, data, headers)
+        self.cookies.add_cookie_header(request)
+        headers = dict(request.header_items())
+        if data is not None and 'Content-type' not in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+
+        pool = self.pool(parts.scheme, parts.netloc)
+        while True:
+            conn, reused = pool.get()
+            closed = False
+            try:
+                try:
+                    conn.request(method, path, data, headers)
+                except socket.error, e:
+                    closed = e.errno in (errno.ECONNRESET, errno.EPIPE)
+                    raise
+                try:
+                    response = conn.getresponse()
+                except httplib.BadStatusLine, e:
+                    closed = e.line in ("''", CLOSED_STATUS_LINE)
+                    raise
+                body = response.read() if stream is None else stream(response)
+            except Exception:
+                # e.g. a corrupt gzip body, the slot must not leak with the connection
+                pool.put(conn, False)
+                if reused and closed:
+                    # the server closed the idle connection before answering, any other
+                    # failure may come after the page ran and must not run it twice
+                    continue
+                raise
+            pool.put(conn, not response.will_close)
+            self.cookies.extract_cookies(CookieResponse(response.msg), request)
+            return response, body
+
+    def request(self, method, path, data=None, headers={}, name=None, stream=False, digest=None, decompress=False):
+        """Sends a request following redirects.
+
+        With `stream` the body isn't kept, the response has no data and its
+        `stream` is a BodyStream with the size, and the hash when `digest`
+        is given. Gzip bodies are inflated on the fly only with `decompress`.
+        """
+        headers = dict(headers)
+        if self.gzip:
+            headers["Accept-Encoding"] = "gzip"
+
+        if data is not None:
+            try:
+                data = urlencode(data)
+            except TypeError:
+                pass  # ignore if someone sends in an already prepared string
+
+        reader = None
+        if stream:
+            reader = lambda response: BodyStream(
+                digest, decompress and response.getheader('content-encoding') == 'gzip').read(response)
+
+        url = self.base_url + path
+        for i in xrange(self.max_redirects + 1):
+            response, body = self._send(method, url, data, headers, reader)
+            location = response.getheader('location')
+            if response.status not in (301, 302, 303, 307) or not location:
+                break
+            if method not in ('GET', 'HEAD'):
+                if response.status == 307:
+                    break
+                method, data = 'GET', None
+            url = urljoin(url, location)
+
+        info = response.msg
+        if stream:
+            stream, body = body, ''
+        else:
+            stream = None
+        if not 200 <= response.status < 300:
+            e = HTTPError(url, response.status, response.reason, info, StringIO(body))
+            e.locust_http_response = HttpResponse(method, url, name, response.status, body, lambda: info, self.gzip,
+                                                  stream)
+            raise e
+
+        return HttpResponse(method, url, name, response.status, body, lambda: info, self.gzip, stream)
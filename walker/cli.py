@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Command line interface, run with python -m walker.
+
+Commands import what they use when they run, only walks patch the standard
+library for gevent.
+"""
+
+from optparse import OptionParser
+import datetime
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+
+def make_parser():
+    parser = OptionParser(usage="%prog [walk] -u URLS -o REPORT [options]\n"
+                                "       %prog [walk] --since SNAPSHOT -s SNAPSHOT -o REPORT [options]\n"
+                                "       %prog report -i COVERAGE -o REPORT\n"
+                                "       %prog convert -i COVERAGE -s SNAPSHOT\n"
+                                "       %prog merge -s SNAPSHOT SNAPSHOT...\n"
+                                "       %prog minimize -i COVERAGE --output URLS\n"
+                                "       %prog index -i SNAPSHOT\n"
+                                "       %prog query -i SNAPSHOT FILE:LINE|URL...\n"
+                                "       %prog collect -s SNAPSHOT [--rotate SECONDS] [--sample RATIO]\n\n"
+                                "URLS may be gzip compressed or - for stdin. COVERAGE is a snapshot,\n"
+                                "a database written with --db or a JSON file.")
+    parser.add_option("-u", "--urls", dest="urls", help="path to urls file")
+    parser.add_option("-g", "--group", dest="group", help="code coverage group, defaults to the journal's or walker")
+    parser.add_option("-r", "--regex", dest="regex", help="regex to match urls", default=None)
+    parser.add_option("-x", "--exclude", dest="exclude", help="regex for urls to skip", default=None)
+    parser.add_option("--rewrite", dest="rewrite", help="replace FROM with TO in urls, may be repeated",
+                      metavar="FROM=TO", action="append", default=None)
+    parser.add_option("--no-rewrite", dest="no_rewrite", help="walk urls as they are", action="store_true", default=False)
+    parser.add_option("--shard", dest="shard", help="walk only shard K of N of the urls, K counts from 1", metavar="K/N")
+    parser.add_option("--shard-by", dest="shard_by", help="shard urls by url hash or line number",
+                      type="choice", choices=["hash", "index"], default="hash")
+    parser.add_option("--count", dest="count", help="count urls in the background for progress", action="store_true", default=False)
+    parser.add_option("--output", dest="output", help="urls file minimize writes")
+    parser.add_option("-i", "--input", dest="input", help="coverage to build the report from")
+    parser.add_option("-o", "--report", dest="report", help="file name for report")
+    parser.add_option("-l", "--lines", dest="lines", help="collect only lines, not count", action="store_true", default=False)
+    parser.add_option("-p", "--path", dest="path", help="path to collect coverage for", default=None)
+    parser.add_option("-v", "--verbose", dest="verbose", help="verbose output", action="store_true", default=False)
+    parser.add_option("-c", "--concurrency", dest="concurrency", help="number of urls walked at once", type="int", default=10)
+    parser.add_option("--per-host", dest="per_host", help="max requests in flight per host, 0 for no limit", type="int", default=0)
+    parser.add_option("--rps", dest="rps", help="max requests per second, 0 for no limit", type="float", default=0)
+    parser.add_option("--pool-size", dest="pool_size", help="max keep-alive connections per host, defaults to concurrency", type="int", default=0)
+    parser.add_option("--idle-timeout", dest="idle_timeout", help="seconds before an idle connection is closed", type="float", default=15.0)
+    parser.add_option("-t", "--transport", dest="transport", help="how PHP sends reports: udp, tcp or unix", type="choice", choices=["udp", "tcp", "unix"], default="udp")
+    parser.add_option("--listen", dest="listen", help="address the collector listens on", metavar="HOST:PORT",
+                      default="127.0.0.1:5555")
+    parser.add_option("--advertise", dest="advertise", help="host PHP sends reports to, defaults to the --listen host "
+                      "or the name of this machine when listening on all addresses")
+    parser.add_option("--collectors", dest="collectors", help="processes collecting udp or tcp reports on the same port",
+                      type="int", default=1)
+    parser.add_option("--checkpoint", dest="checkpoint", help="seconds between saving --snapshot while walking "
+                      "with --collectors, 0 to save it only at the end", type="float", default=0)
+    parser.add_option("--socket", dest="socket", help="unix socket path for --transport=unix", default="/tmp/walker.sock")
+    parser.add_option("--decoders", dest="decoders", help="threads decoding reports, 0 to decode on the event loop", type="int", default=2)
+    parser.add_option("--decode-batch", dest="decode_batch", help="max reports decoded at once by a thread", type="int", default=64)
+    parser.add_option("--db", dest="db", help="save coverage to this database while walking")
+    parser.add_option("--flush-interval", dest="flush_interval", help="seconds between database flushes", type="float", default=30.0)
+    parser.add_option("-s", "--snapshot", dest="snapshot", help="save coverage to this snapshot after walking, "
+                      "the snapshot convert and merge write, or the name collect adds times to")
+    parser.add_option("--since", dest="since", help="walk again only urls of this snapshot that covered files "
+                      "changed since, and merge with its coverage into --snapshot", metavar="SNAPSHOT")
+    parser.add_option("--rotate", dest="rotate", help="seconds between snapshots of collect",
+                      type="float", default=3600.0)
+    parser.add_option("--rotate-size", dest="rotate_size", help="MB of coverage collect rotates the snapshot at, "
+                      "0 for no limit", type="int", default=0)
+    parser.add_option("--max-memory", dest="max_memory", help="MB of memory collect rotates the snapshot early at, "
+                      "0 for no limit", type="int", default=0)
+    parser.add_option("--sample", dest="sample", help="ratio of reports collect decodes, the rest are skipped",
+                      type="float", default=1.0)
+    parser.add_option("--drain", dest="drain", help="seconds to wait for reports of walked urls at the end",
+                      type="float", default=5.0)
+    parser.add_option("--lost", dest="lost", help="save urls whose reports didn't arrive to this file")
+    parser.add_option("--journal", dest="journal", help="append walked urls to this file")
+    parser.add_option("--resume", dest="resume", help="skip urls already in --journal, except connection errors",
+                      action="store_true", default=False)
+    parser.add_option("-j", "--jobs", dest="jobs", help="processes highlighting source files for the report", type="int", default=1)
+    parser.add_option("--split", dest="split", help="write the report to a directory with a page per file or dir",
+                      type="choice", choices=["file", "dir"], default=None)
+    parser.add_option("--cache", dest="cache", help="directory to cache highlighted source files in")
+    parser.add_option("--cache-size", dest="cache_size", help="max size of the cache in MB", type="int", default=512)
+    parser.add_option("--metrics", dest="metrics", help="save metrics of the walk to this file, JSON for *.json "
+                      "or Prometheus text format")
+    parser.add_option("--metrics-port", dest="metrics_port", help="serve /metrics and /metrics.json on this "
+                      "local port while walking", type="int", default=0)
+    parser.add_option("--profile", dest="profile", help="save profiles of the walk and the report to this directory")
+    parser.add_option("--progress", dest="progress", help="seconds between progress reports", type="float", default=10.0)
+    return parser
+
+
+def render_cache(options):
+    from walker.report import RenderCache
+    if options.cache:
+        return RenderCache(options.cache, options.cache_size * 1024 * 1024)
+
+
+def write_report(options, coverage, profiler=None):
+    from walker.metrics import SPANS
+    from walker.report import generate_report
+    args = (coverage, options.report, options.jobs, render_cache(options), options.split)
+    if profiler is not None:
+        profiler.profile('report', generate_report, *args, profiler=profiler)
+    else:
+        generate_report(*args)
+    print "Spans:", SPANS.summary()
+
+
+def report(options):
+    from walker.metrics import Profiler
+    write_report(options, options.input, Profiler(options.profile) if options.profile else None)
+    print "Report saved to %s" % options.report
+
+
+def convert(options):
+    from walker.snapshot import load_coverage, write_snapshot
+    count = write_snapshot(load_coverage(options.input), options.snapshot)
+    print "Snapshot of %d files saved to %s" % (count, options.snapshot)
+
+
+def merge(options):
+    from walker.snapshot import Snapshot, SourceManifest, merge_snapshots
+    count = merge_snapshots([Snapshot(path) for path in options.inputs], options.snapshot)
+    manifest = SourceManifest(options.snapshot)
+    manifest.files = {}
+    for path in reversed(options.inputs):
+        manifest.files.update(SourceManifest(path).files)
+    manifest.save()
+    print "Merged %d snapshots, %d files saved to %s" % (len(options.inputs), count, options.snapshot)
+
+
+def minimize(options):
+    from walker.snapshot import Snapshot, cover_urls, load_coverage, write_snapshot
+    coverage = load_coverage(options.input)
+    if not isinstance(coverage, Snapshot):
+        directory = tempfile.mkdtemp(prefix='walker')
+        try:
+            path = os.path.join(directory, 'coverage.snap')
+            write_snapshot(coverage, path)
+            coverage = Snapshot(path)
+        finally:
+            shutil.rmtree(directory)
+    if coverage.lines_only or not len(coverage.url_bounds):
+        sys.stderr.write("%s has no urls, walk without --lines!\n" % options.input)
+        sys.exit(1)
+
+    picked, lines = cover_urls(coverage)
+    with open(options.output, 'w') as f:
+        for url in picked:
+            f.write(coverage.url(url) + '\n')
+    print "%d of %d urls cover the same %d lines, saved to %s" % (
+        len(picked), len(coverage.url_bounds), lines, options.output)
+
+
+def index(options):
+    from walker.index import write_index
+    from walker.snapshot import Snapshot
+    snapshot = Snapshot(options.input)
+    write_index(snapshot, options.input + '.index')
+    print "Index of %d urls and %d files saved to %s.index" % (
+        len(snapshot.url_bounds), len(snapshot), options.input)
+
+
+def query(options):
+    from walker.index import CoverageIndex
+    try:
+        coverage_index = CoverageIndex(options.input)
+    except (IOError, ValueError):
+        # missing, of an older format or of the snapshot before it was rewritten
+        index(options)
+        coverage_index = CoverageIndex(options.input)
+    for term in options.inputs:
+        filename, sep, line = term.rpartition(':')
+        if '://' not in term and line.isdigit():
+            urls = coverage_index.urls(filename, int(line))
+            print "%s: %d urls" % (term, len(urls))
+            for url in urls:
+                print "  %s" % url
+        else:
+            files = coverage_index.files(term)
+            print "%s: %d files" % (term, len(files))
+            for filename, lines in sorted(files.items()):
+                print "  %s: %s" % (filename, ' '.join(str(line) for line in lines))
+
+
+def parse_shard(shard):
+    """(index, count) from K/N with K counting from 1."""
+    try:
+        index, count = [int(part) for part in shard.split('/')]
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        sys.stderr.write("--shard must be K/N with 1 <= K <= N!\n")
+        sys.exit(1)
+    return index - 1, count
+
+
+def listen_address(options):
+    host, sep, port = options.listen.rpartition(':')
+    return host.strip('[]'), int(port)
+
+
+def make_collector(options, reuse_port=False):
+    """Collector of --transport, processes share udp and tcp ports with `reuse_port`."""
+    from gevent.pool import Pool
+    from walker.collector import CoverageServer, CoverageStreamServer, reuseport_listener, unix_listener
+    host, port = listen_address(options)
+    if options.transport == 'udp':
+        server = CoverageServer(reuseport_listener((host, port)) if reuse_port else (host, port),
+                                spawn=Pool(100))
+    elif options.transport == 'tcp':
+        server = CoverageStreamServer(reuseport_listener((host, port), socket.SOCK_STREAM)
+                                      if reuse_port else (host, port))
+    else:
+        server = CoverageStreamServer(unix_listener(options.socket))
+    return server.lines(options.lines).path(options.path).decoders(options.decoders, options.decode_batch)
+
+
+def collect(options):
+    import gevent
+    from walker.collector import SnapshotRotation
+    from walker.metrics import Metrics
+    from walker.walk import WalkStats
+
+    if not 0 < options.sample <= 1:
+        sys.stderr.write("--sample must be a ratio above 0 and up to 1!\n")
+        sys.exit(1)
+    if options.collectors > 1 or options.db or options.checkpoint:
+        sys.stderr.write("collect doesn't support --collectors, --db or --checkpoint, use --rotate!\n")
+        sys.exit(1)
+    server = make_collector(options).sample(options.sample)
+    rotation = SnapshotRotation(server, options.snapshot, options.rotate, options.rotate_size * 1024 * 1024,
+                                options.max_memory * 1024 * 1024)
+    metrics = Metrics(WalkStats(), server)
+    if options.metrics_port:
+        metrics.serve(options.metrics_port)
+
+    def progress():
+        while not rotation.stopped.wait(options.progress):
+            print server.progress()
+
+    print "Collecting %s reports on %s, %d%% sampled, rotating every %.0fs" % (
+        options.transport, options.socket if options.transport == 'unix' else options.listen,
+        options.sample * 100, options.rotate)
+    # stop on the loop, ^C would interrupt whichever greenlet runs
+    gevent.signal_handler(signal.SIGTERM, server.stop)
+    gevent.signal_handler(signal.SIGINT, server.stop)
+    server.start()
+    rotation.start()
+    gevent.spawn(progress)
+    server.serve_forever()
+    rotation.stop()
+    metrics.close()
+    print "Reports:", ", ".join("%d %s" % (count, name) for name, count in sorted(server.stats.items()))
+    if options.metrics:
+        metrics.save(options.metrics)
+        print "Metrics saved to %s" % options.metrics
+    if rotation.snapshots:
+        print "%d snapshots saved, merge them with: merge -s SNAPSHOT %s" % (
+            len(rotation.snapshots), ' '.join(rotation.snapshots))
+
+
+def walk(options):
+    import gevent
+    from walker.browser import HttpBrowser
+    from walker.collector import CollectorProcesses
+    from walker.metrics import Metrics, Profiler
+    from walker.snapshot import Snapshot, SourceManifest, carry_forward, merge_snapshots, rewalk_urls
+    from walker.store import CoverageDatabase
+    from walker.walk import DEFAULT_REWRITES, ReportTracker, UrlSource, WalkJournal, WalkScheduler, url_key
+
+    host, port = listen_address(options)
+    advertise = options.advertise or (socket.getfqdn() if host in ('', '0.0.0.0', '::') else host)
+
+    client = HttpBrowser('', True, options.pool_size or options.concurrency, options.idle_timeout)
+    directory = None
+    previous = None
+    if options.since:
+        if not options.snapshot:
+            sys.stderr.write("--since needs a --snapshot!\n")
+            sys.exit(1)
+        previous = Snapshot(options.since)
+        if previous.lines_only:
+            sys.stderr.write("%s has no urls, walk without --lines!\n" % options.since)
+            sys.exit(1)
+        manifest = SourceManifest(options.since)
+        changed = manifest.changed(previous.filenames)
+        rewalk = rewalk_urls(previous, changed)
+        print "%d of %d files changed since %s, walking %d of %d urls again" % (
+            len(changed), len(previous), options.since, len(rewalk), len(previous.url_bounds))
+        directory = tempfile.mkdtemp(prefix='walker')
+        options.urls = os.path.join(directory, 'urls.txt')
+        # reported urls are rewritten already
+        options.no_rewrite = True
+        with open(options.urls, 'w') as f:
+            for url in sorted(rewalk):
+                f.write(previous.url(url) + '\n')
+    elif not options.urls:
+        sys.stderr.write("No urls file specified!\n")
+        sys.exit(1)
+
+    source = UrlSource(options.urls)
+    if options.shard:
+        index, count = parse_shard(options.shard)
+        source.shard(index, count, options.shard_by)
+    if options.regex:
+        source.include(options.regex)
+    if options.exclude:
+        source.exclude(options.exclude)
+    if not options.no_rewrite:
+        for rewrite in options.rewrite or DEFAULT_REWRITES:
+            old, sep, new = rewrite.partition('=')
+            source.rewrite(old, new)
+
+    journal = None
+    if options.resume and not options.journal:
+        sys.stderr.write("--resume needs a --journal!\n")
+        sys.exit(1)
+    if options.journal:
+        journal = WalkJournal(options.journal, options.group or "walker")
+        options.group = options.group or journal.group
+        if options.resume:
+            walked = journal.walked()
+            print "Resuming group %s, skipping %d walked urls" % (journal.group, len(walked))
+            source.stage(lambda url: None if url_key(url) in walked else url)
+    options.group = options.group or "walker"
+
+    if options.collectors > 1:
+        if options.transport == 'unix' or options.db:
+            sys.stderr.write("--collectors works with udp or tcp transport and without --db!\n")
+            sys.exit(1)
+        directory = directory or tempfile.mkdtemp(prefix='walker')
+        server = CollectorProcesses(lambda: make_collector(options, True), options.collectors, directory)
+    else:
+        server = make_collector(options)
+    if options.db:
+        server.database(CoverageDatabase(options.db), options.flush_interval)
+    if options.transport == 'unix':
+        advertise, port = options.socket, 0
+
+    headers = {'X-Walker': 'yes', 'X-Walker-Group': options.group, 'X-Walker-Host': advertise, 'X-Walker-Port': port,
+               'X-Walker-Transport': options.transport}
+    scheduler = WalkScheduler(client, headers, options.concurrency, options.per_host, options.rps,
+                              options.progress, options.verbose)
+    scheduler.status = server.progress
+    scheduler.journal = journal
+    scheduler.tracker = tracker = ReportTracker()
+    server.track(tracker.reported)
+    lost = []
+    profiler = Profiler(options.profile) if options.profile else None
+    if profiler is not None and options.collectors > 1:
+        server.profile(profiler)
+    metrics = Metrics(scheduler.stats, server)
+    if options.metrics_port:
+        metrics.serve(options.metrics_port)
+
+    def counter(source, stats):
+        # counting is plain blocking file io, keep it off the event loop
+        stats.total = gevent.get_hub().threadpool.apply(source.count)
+
+    def checkpoints(server):
+        while not server.stopped.wait(options.checkpoint):
+            server.save(options.snapshot)
+            print "Checkpoint saved to %s" % options.snapshot
+
+    def walker(source, scheduler, server):
+        if options.count:
+            gevent.spawn(counter, source, scheduler.stats)
+        scheduler.run(source)
+        scheduler.client.close()
+        if len(tracker):
+            print "Waiting up to %.1fs for %d reports" % (options.drain, len(tracker))
+        lost.extend(tracker.drain(options.drain))
+        server.stop()
+
+    print "Start at", datetime.datetime.now()
+    t = time.time()
+    walking = None
+    try:
+        if profiler is not None:
+            profiler.start()
+        server.start()
+        walking = gevent.spawn(walker, source, scheduler, server)
+        if directory is not None and options.snapshot and options.checkpoint > 0:
+            gevent.spawn(checkpoints, server)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        # nothing may request, or write to the journal, once the collector stopped
+        if walking is not None:
+            walking.kill()
+        scheduler.stop()
+        client.close()
+        server.stop()
+    except Exception, e:
+        print e
+    if profiler is not None:
+        profiler.stop('walk')
+
+    if journal is not None:
+        journal.close()
+    print "Stop walking at", datetime.datetime.now(), "walk for %3.4fsec" % (time.time() - t)
+    print server.progress()
+    print "Reports:", ", ".join("%d %s" % (count, name) for name, count in sorted(server.stats.items()))
+    if lost:
+        print "%d reports lost" % len(lost)
+    if options.lost:
+        with open(options.lost, 'w') as f:
+            for url in lost:
+                f.write(url + '\n')
+        print "Urls without reports saved to %s" % options.lost
+    metrics.close()
+    if options.snapshot or directory is not None:
+        path = options.snapshot or os.path.join(directory, 'coverage.snap')
+        if previous is not None:
+            server.save(os.path.join(directory, 'walked.snap'))
+            carry_forward(previous, changed, rewalk, os.path.join(directory, 'carried.snap'))
+            merge_snapshots([Snapshot(os.path.join(directory, name)) for name in ('carried.snap', 'walked.snap')], path)
+        else:
+            server.save(path)
+        snapshot = Snapshot(path)
+        if options.snapshot:
+            new = SourceManifest(options.snapshot)
+            if previous is not None:
+                new.files = manifest.files
+            new.update(snapshot.filenames).save()
+            print "Snapshot saved to %s" % options.snapshot
+        write_report(options, snapshot, profiler)
+    elif options.db:
+        write_report(options, server.db, profiler)
+    else:
+        write_report(options, server.coverage.to_dict(queries=False), profiler)
+    if directory is not None:
+        shutil.rmtree(directory)
+    print "Report saved to %s" % options.report
+    if options.metrics:
+        metrics.save(options.metrics)
+        print "Metrics saved to %s" % options.metrics
+    if profiler is not None:
+        metrics.save(os.path.join(options.profile, 'metrics.json'))
+        print "Profiles saved to %s" % options.profile
+
+
+COMMANDS = {
+    'walk': (walk, [('report', "report filename")]),
+    'report': (report, [('input', "coverage file"), ('report', "report filename")]),
+    'convert': (convert, [('input', "coverage file"), ('snapshot', "snapshot filename")]),
+    'merge': (merge, [('inputs', "snapshots to merge"), ('snapshot', "snapshot filename")]),
+    'minimize': (minimize, [('input', "coverage file"), ('output', "urls filename")]),
+    'index': (index, [('input', "snapshot file")]),
+    'query': (query, [('input', "snapshot file"), ('inputs', "FILE:LINE or url to look up")]),
+    'collect': (collect, [('snapshot', "snapshot filename")]),
+}
+
+
+def main():
+    parser = make_parser()
+    (options, args) = parser.parse_args()
+    command = args[0] if args else 'walk'
+    options.inputs = args[1:]
+    if command not in COMMANDS:
+        sys.stderr.write("Unknown command %s!\n" % command)
+        parser.print_usage()
+        sys.exit(1)
+
+    func, required = COMMANDS[command]
+    for name, title in required:
+        if not getattr(options, name):
+            sys.stderr.write("No %s specified!\n" % title)
+            parser.print_usage()
+            sys.exit(1)
+
+    if command == 'walk':
+        # urllib2 and httplib block the walk unless sockets are cooperative
+        from gevent.monkey import patch_all
+        patch_all()
+    func(options)
+    print "Bye, bye!"
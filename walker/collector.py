@@ -0,0 +1,752 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collectors of coverage reports sent by PHP."""
+
+import gc
+import os
+import random
+import signal
+import socket
+import struct
+import time
+import zlib
+from collections import OrderedDict
+
+import ujson
+import gevent
+import gevent.os
+import gevent.socket
+from gevent.event import AsyncResult, Event
+from gevent.lock import Semaphore
+from gevent.queue import Queue
+from gevent.server import DatagramServer, StreamServer
+from gevent.threadpool import ThreadPool
+
+from walker.metrics import SPANS, Spans
+from walker.pool import LENGTH, send_message, recv_message
+from walker.snapshot import Snapshot, write_snapshot, merge_snapshots
+from walker.store import CoverageStore
+
+
+# Framed datagram header: magic, report id, chunk index, chunk count.
+FRAME = struct.Struct('!4sIHH')
+
+
+FRAME_MAGIC = 'WLK1'
+
+
+LEGACY_CHUNK = 8192
+
+
+def decode_report(data, prefix=None, compressed=True):
+    """Decompress and decode a report.
+
+    Returns the query, a list of (filename, sorted lines) for files
+    coverage is collected for and the X-Walker-Id of the request or None.
+    """
+    report = ujson.decode(zlib.decompress(data) if compressed else data)
+    """
+    'coverage' => $coverage,
+    'pinba' => Ngs_Debug::pinbaRaw()
+    """
+
+    #request = "http://%s%s" % (report['server'], report['uri'])
+    query = "http://%s%s" % (report['server'], report['query'])
+    #pinba = report['pinba']
+    #group = report['group']
+
+    files = []
+    for filename, lines in report['coverage'].items():
+        filename = str(filename)
+        if prefix and prefix not in filename:
+            continue
+        if '/data/tmp/' in filename:  # skip templates
+            continue
+        lines = sorted(int(line) for line in lines)
+        if lines and lines[0] < 1:
+            raise ValueError("line %d of %s" % (lines[0], filename))
+        files.append((filename, lines))
+    id = report.get('id')
+    return query, files, str(id) if id is not None else None
+
+
+def decode_batch(batch, prefix=None):
+    """Decodes a list of reports, malformed ones are returned as exceptions.
+
+    Returns the reports, seconds spent and the size of decompressed reports.
+    """
+    started = time.time()
+    reports = []
+    size = 0
+    for data in batch:
+        try:
+            data = zlib.decompress(data)
+            size = size + len(data)
+            reports.append(decode_report(data, prefix, compressed=False))
+        except Exception, e:
+            reports.append(e)
+    return reports, time.time() - started, size
+
+
+class IngestPipeline(object):
+    """Decode reports off the gevent loop.
+
+    Socket handlers only put raw payloads. A batcher greenlet hands batches
+    of up to `batch` payloads to a pool of `workers` native threads that
+    decompress and decode them, and a single merger greenlet applies the
+    decoded reports to the collector's store in arrival order. With no
+    workers reports are decoded by the batcher itself.
+    """
+
+    def __init__(self, collector, workers=2, batch=64):
+        self.collector = collector
+        self.workers = workers
+        self.batch = batch
+        self.incoming = Queue()
+        self.decoded = Queue(max(workers, 1) * 2)
+        self.pool = None
+        self.greenlets = []
+        self.closing = False
+        self.peak = 0
+        self.stats = dict.fromkeys(['batches', 'reports', 'bytes', 'decompressed_bytes'], 0)
+        self.spans = Spans()
+
+    def start(self):
+        if self.greenlets:
+            return
+        if self.workers:
+            self.pool = ThreadPool(self.workers)
+        self.closing = False
+        self.greenlets = [gevent.spawn(self.batcher), gevent.spawn(self.merger)]
+
+    def put(self, data):
+        self.stats['bytes'] = self.stats['bytes'] + len(data)
+        self.incoming.put(data)
+        if self.incoming.qsize() > self.peak:
+            self.peak = self.incoming.qsize()
+
+    def batcher(self):
+        prefix = self.collector.prefix
+        running = True
+        while running:
+            batch = [self.incoming.get()]
+            while len(batch) < self.batch and not self.incoming.empty():
+                batch.append(self.incoming.get_nowait())
+            if StopIteration in batch:
+                running = False
+                batch = batch[:batch.index(StopIteration)]
+                if not batch:
+                    break
+            queued = time.time()
+            if self.pool is not None:
+                self.decoded.put((queued, self.pool.spawn(decode_batch, batch, prefix)))
+            else:
+                result = AsyncResult()
+                result.set(decode_batch(batch, prefix))
+                self.decoded.put((queued, result))
+        self.decoded.put(StopIteration)
+
+    def merger(self):
+        for queued, result in self.decoded:
+            reports, elapsed, size = result.get()
+            started = time.time()
+            self.spans.add('decode', elapsed, len(reports))
+            self.spans.add('wait', started - queued)
+            self.stats['batches'] = self.stats['batches'] + 1
+            self.stats['reports'] = self.stats['reports'] + len(reports)
+            self.stats['decompressed_bytes'] = self.stats['decompressed_bytes'] + size
+            for report in reports:
+                if not isinstance(report, Exception):
+                    try:
+                        self.collector.merge(*report)
+                        continue
+                    except Exception, e:
+                        report = e
+                # one bad report must not stop merging the rest
+                self.collector.stats['malformed'] = self.collector.stats['malformed'] + 1
+                print "Malformed report:", report
+            self.spans.add('merge', time.time() - started, len(reports))
+
+    def close(self):
+        """Decodes and merges everything queued so far and stops."""
+        if not self.greenlets:
+            return
+        if not self.closing:
+            self.closing = True
+            self.incoming.put(StopIteration)
+        gevent.joinall(self.greenlets)
+        self.greenlets = []
+        if self.pool is not None:
+            self.pool.kill()
+            self.pool = None
+
+    def metrics(self):
+        metrics = dict(('ingest_%s_total' % name, count) for name, count in self.stats.items())
+        metrics.update(self.spans.metrics('ingest_'))
+        metrics['ingest_queued'] = self.incoming.qsize()
+        metrics['ingest_queued_peak'] = self.peak
+        return metrics
+
+    def progress(self):
+        return "ingest: %d queued (peak %d), %d decoding, %d reports in %d batches, " \
+               "decode %3.3fs, merge %3.3fs, wait %3.3fs" % (
+                   self.incoming.qsize(), self.peak, self.decoded.qsize(), self.stats['reports'],
+                   self.stats['batches'], self.spans.seconds['decode'], self.spans.seconds['merge'],
+                   self.spans.seconds['wait'])
+
+
+class CoverageCollector(object):
+    """Aggregate coverage reports, shared by the datagram and stream servers."""
+
+    lines_only = False
+    prefix = None
+    ratio = 1.0
+
+    def __init__(self, *args, **kwargs):
+        super(CoverageCollector, self).__init__(*args, **kwargs)
+        self.coverage = CoverageStore(self.lines_only)
+        self.ingest = IngestPipeline(self)
+        self.db = None
+        self.flusher = None
+        self.flush_lock = Semaphore()
+        self.stopping = Event()
+        self.tracker = None
+        self.stats = dict.fromkeys(['completed', 'malformed', 'skipped'], 0)
+
+    def lines(self, only_line=False):
+        self.lines_only = only_line
+        self.coverage.lines_only = only_line
+        return self
+
+    def path(self, path=False):
+        self.prefix = path
+        return self
+
+    def track(self, reported):
+        """Calls `reported` with the X-Walker-Id of every report that has one."""
+        self.tracker = reported
+        return self
+
+    def sample(self, ratio=1.0):
+        """Decodes only a random `ratio` of the reports, the rest are skipped."""
+        self.ratio = ratio
+        return self
+
+    def decoders(self, workers=2, batch=64):
+        self.ingest.workers = workers
+        self.ingest.batch = batch
+        return self
+
+    def database(self, db, interval=30.0):
+        """Flush collected coverage to a CoverageDatabase every `interval` seconds."""
+        self.db = db
+        self.flush_interval = interval
+        db.load(self.coverage)
+        return self
+
+    def start(self):
+        self.ingest.start()
+        if self.db is not None and self.flusher is None:
+            self.stopping.clear()
+            self.flusher = gevent.spawn(self.flush_forever)
+        super(CoverageCollector, self).start()
+
+    def stop(self, timeout=None):
+        super(CoverageCollector, self).stop(timeout)
+        self.ingest.close()
+        if self.flusher is not None:
+            self.stopping.set()
+            self.flusher.join()
+            self.flusher = None
+            self.flush()
+
+    def save(self, path):
+        """Writes everything collected to a snapshot, from the database when
+        there is one. Blocks the event loop, call it once ingest is stopped."""
+        with SPANS.span('snapshot'):
+            return write_snapshot(self.db if self.db is not None else self.coverage, path)
+
+    def progress(self):
+        return self.ingest.progress()
+
+    def metrics(self):
+        """Counters named like Prometheus metrics without the walker_ prefix."""
+        metrics = self.ingest.metrics()
+        metrics.update(('collector_%s_total' % name, count) for name, count in self.stats.items())
+        return metrics
+
+    def flush_forever(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Writes coverage collected since the last flush to the database.
+
+        Writing runs in a native thread, reports keep being merged into a new
+        batch meanwhile.
+        """
+        with self.flush_lock:
+            delta = self.coverage.detach()
+            if delta.coverage or delta.new_files or delta.new_urls:
+                gevent.get_hub().threadpool.apply(self.db.write, (delta,))
+
+    def rotate(self, path):
+        """Writes everything collected so far to a snapshot at `path` in a native
+        thread and starts over with an empty store. Returns the number of
+        files written, no snapshot is written when nothing was collected."""
+        coverage, self.coverage = self.coverage, CoverageStore(self.lines_only)
+        if not len(coverage):
+            return 0
+        with SPANS.span('snapshot'):
+            return gevent.get_hub().threadpool.apply(write_snapshot, (coverage, path))
+
+    def complete(self, data):
+        if self.ratio < 1.0 and random.random() >= self.ratio:
+            self.stats['skipped'] = self.stats['skipped'] + 1
+            return
+        self.ingest.put(data)
+
+    def merge(self, query, files, id=None):
+        for filename, lines in files:
+            self.coverage.add(filename, lines, query)
+        self.stats['completed'] = self.stats['completed'] + 1
+        if id is not None and self.tracker is not None:
+            self.tracker(id)
+
+        #print "Got report for", request, query, group, pinba['request']['time']['human'], len(coverage)
+
+
+class CoverageServer(CoverageCollector, DatagramServer):
+    """Collect coverage reports sent by PHP over UDP.
+
+    Reports bigger than a datagram are split in chunks, each prefixed with
+    FRAME. Chunks are reassembled per sender and report id, so reports from
+    many PHP workers can arrive interleaved. Unframed payloads are still
+    accepted: a full 8192 bytes datagram means more chunks from the same
+    sender will follow.
+    """
+
+    timeout = 30.0
+    max_pending = 64 * 1024 * 1024
+
+    def __init__(self, *args, **kwargs):
+        super(CoverageServer, self).__init__(*args, **kwargs)
+        self.pending = OrderedDict()
+        self.pending_size = 0
+        self.rejected = OrderedDict()
+        self.swept = time.time()
+        self.stats.update(dict.fromkeys(['datagrams', 'expired', 'dropped'], 0))
+
+    def handle(self, data, address):
+        self.stats['datagrams'] = self.stats['datagrams'] + 1
+        now = time.time()
+        if now - self.swept > 1.0:
+            self.expire(now)
+
+        if data[:4] == FRAME_MAGIC:
+            if len(data) < FRAME.size:
+                self.stats['malformed'] = self.stats['malformed'] + 1
+                return
+            magic, report_id, index, count = FRAME.unpack_from(data)
+            if index >= count:
+                self.stats['malformed'] = self.stats['malformed'] + 1
+                return
+            if count == 1:
+                return self.complete(data[FRAME.size:])
+            self.add_chunk((address, report_id), index, count, data[FRAME.size:], now)
+        else:
+            key = (address, None)
+            if len(data) == LEGACY_CHUNK:
+                entry = self.pending.get(key)
+                self.add_chunk(key, len(entry[2]) if entry else 0, None, data, now)
+            elif key in self.pending:
+                entry = self.pending[key]
+                self.add_chunk(key, len(entry[2]), len(entry[2]) + 1, data, now)
+            else:
+                self.complete(data)
+
+    def add_chunk(self, key, index, count, chunk, now):
+        if key in self.rejected:
+            return
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = [now, count, {}]
+        elif index in entry[2]:
+            return  # duplicate
+        if count is not None:
+            entry[1] = count
+
+        entry[2][index] = chunk
+        self.pending_size = self.pending_size + len(chunk)
+        while self.pending_size > self.max_pending:
+            oldest = next(iter(self.pending))
+            self.discard(oldest)
+            self.reject(oldest)
+            self.stats['dropped'] = self.stats['dropped'] + 1
+            if oldest == key:
+                return
+
+        if len(entry[2]) == entry[1]:
+            self.discard(key)
+            self.complete("".join(entry[2][i] for i in xrange(entry[1])))
+
+    def discard(self, key):
+        entry = self.pending.pop(key)
+        self.pending_size = self.pending_size - sum(len(chunk) for chunk in entry[2].values())
+
+    def reject(self, key):
+        # remember dropped reports for a while so their late chunks are ignored,
+        # unframed chunks can't be told apart from the sender's next report
+        if key[1] is None:
+            return
+        self.rejected[key] = True
+        if len(self.rejected) > 1024:
+            self.rejected.popitem(last=False)
+
+    def expire(self, now):
+        self.swept = now
+        for key, entry in self.pending.items():
+            if now - entry[0] < self.timeout:
+                break
+            self.discard(key)
+            self.stats['expired'] = self.stats['expired'] + 1
+
+
+class CoverageStreamServer(CoverageCollector, StreamServer):
+    """Collect coverage reports sent over TCP or a unix socket.
+
+    Every report is a 4 bytes big-endian length followed by that many bytes
+    of zlib compressed JSON. A connection may carry any number of reports.
+    """
+
+    max_report = 256 * 1024 * 1024
+
+    def __init__(self, *args, **kwargs):
+        super(CoverageStreamServer, self).__init__(*args, **kwargs)
+        self.stats.update(dict.fromkeys(['connections', 'truncated'], 0))
+
+    def handle(self, sock, address):
+        self.stats['connections'] = self.stats['connections'] + 1
+        rfile = sock.makefile('rb', -1)
+        try:
+            while True:
+                header = rfile.read(LENGTH.size)
+                if not header:
+                    break
+                if len(header) < LENGTH.size:
+                    self.stats['truncated'] = self.stats['truncated'] + 1
+                    break
+                length = LENGTH.unpack(header)[0]
+                if length > self.max_report:
+                    self.stats['malformed'] = self.stats['malformed'] + 1
+                    break
+                data = rfile.read(length)
+                if len(data) < length:
+                    self.stats['truncated'] = self.stats['truncated'] + 1
+                    break
+                self.complete(data)
+        except socket.error:
+            self.stats['truncated'] = self.stats['truncated'] + 1
+        finally:
+            rfile.close()
+            sock.close()
+
+
+def unix_listener(path, backlog=256):
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(backlog)
+    return listener
+
+
+def add_counts(counts):
+    """Sums dicts of counts."""
+    total = {}
+    for count in counts:
+        for name, value in count.items():
+            total[name] = total.get(name, 0) + value
+    return total
+
+
+def reuseport_listener(address, type=socket.SOCK_DGRAM, backlog=256):
+    """Socket bound to `address` with SO_REUSEPORT, other processes may bind it too."""
+    host, port = address
+    listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, type)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(address)
+    if type == socket.SOCK_STREAM:
+        listener.listen(backlog)
+    return listener
+
+
+class CollectorProcesses(object):
+    """Collect coverage in forked processes listening on the same port.
+
+    `factory` is called in every process and returns a collector bound with
+    reuseport_listener. The kernel picks a process by source address, so
+    all chunks of a report reach the same one. Every process keeps its
+    own partial store. At checkpoints while walking a process writes what
+    it collected since the last one to a new snapshot in `directory` and
+    starts over, after stop() it saves the rest. save() merges all of
+    them. Like ProcessPool the parent talks to processes over socket
+    pairs, one command at a time. With track() X-Walker-Ids of reports are
+    collected from the processes every `poll_interval` seconds. With
+    profile() every process samples its stacks until it stops.
+    """
+
+    poll_interval = 0.2
+
+    def __init__(self, factory, processes, directory):
+        self.factory = factory
+        self.processes = processes
+        self.directory = directory
+        self.workers = []
+        self.partials = []
+        self.lock = Semaphore()
+        self.stopped = Event()
+        self.stats = {}
+        self.totals = {}
+        self.tracker = None
+        self.profiler = None
+
+    def track(self, reported):
+        self.tracker = reported
+        return self
+
+    def profile(self, profiler):
+        self.profiler = profiler
+        return self
+
+    def start(self):
+        """Forks the processes and waits until all of them listen."""
+        for i in xrange(self.processes):
+            parent, child = gevent.socket.socketpair()
+            pid = gevent.os.fork_and_watch()
+            if pid == 0:
+                try:
+                    parent.close()
+                    self.serve(child, os.path.join(self.directory, 'collector%d.snap' % i))
+                finally:
+                    os._exit(0)
+            child.close()
+            self.workers.append((pid, parent, parent.makefile('rb', -1)))
+        for pid, sock, rfile in self.workers:
+            recv_message(rfile)
+        if self.tracker is not None:
+            gevent.spawn(self.poll_forever)
+
+    def serve(self, sock, path):
+        # the walker stops collectors on ^C, after they had a chance to save
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.profiler is not None:
+            self.profiler.start()
+        server = self.factory()
+        reported = []
+        server.track(reported.append)
+        server.start()
+        rfile = sock.makefile('rb', -1)
+        send_message(sock, True)
+        partials = []
+        while True:
+            command = recv_message(rfile)
+            if command == 'progress':
+                send_message(sock, server.progress())
+                continue
+            if command == 'metrics':
+                send_message(sock, server.metrics())
+                continue
+            if command == 'reported':
+                send_message(sock, reported)
+                del reported[:]
+                continue
+            if command == 'checkpoint':
+                # written in a native thread from a fresh store, ingest goes on meanwhile
+                checkpoint = '%s-%d.snap' % (os.path.splitext(path)[0], len(partials) + 1)
+                if server.rotate(checkpoint):
+                    partials.append(checkpoint)
+                send_message(sock, (partials, server.stats, server.metrics()))
+                continue
+            server.stop()
+            if self.profiler is not None:
+                self.profiler.stop(os.path.splitext(os.path.basename(path))[0])
+            server.save(path)
+            send_message(sock, (partials + [path], server.stats, server.metrics()))
+            break
+
+    def command(self, command):
+        """Replies of all processes to `command`, the caller holds the lock.
+        Processes that died are reaped and left out, their reports are lost."""
+        replies = []
+        for worker in list(self.workers):
+            pid, sock, rfile = worker
+            try:
+                send_message(sock, command)
+                reply = recv_message(rfile)
+            except socket.error:
+                reply = None
+            if reply is None:
+                print "Collector process %d exited, its reports are lost" % pid
+                self.workers.remove(worker)
+                rfile.close()
+                sock.close()
+                gevent.os.waitpid(pid, 0)
+                continue
+            replies.append(reply)
+        return replies
+
+    def serve_forever(self):
+        if not self.workers:
+            self.start()
+        self.stopped.wait()
+
+    def poll_forever(self):
+        while not self.stopped.wait(self.poll_interval):
+            with self.lock:
+                replies = self.command('reported')
+            for ids in replies:
+                for id in ids:
+                    self.tracker(id)
+
+    def stop(self, timeout=None):
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            replies = self.command('stop')
+            self.partials = [path for paths, stats, metrics in replies for path in paths]
+            self.stats = add_counts([stats for path, stats, metrics in replies])
+            self.totals = add_counts([metrics for path, stats, metrics in replies])
+            for pid, sock, rfile in self.workers:
+                rfile.close()
+                sock.close()
+                gevent.os.waitpid(pid, 0)
+            self.workers = []
+            self.stopped.set()
+
+    def progress(self):
+        with self.lock:
+            return "\n".join("collector %d %s" % (i + 1, progress)
+                             for i, progress in enumerate(self.command('progress'))) or \
+                "%d collectors stopped" % self.processes
+
+    def metrics(self):
+        with self.lock:
+            if not self.workers:
+                return self.totals
+            return add_counts(self.command('metrics'))
+
+    def save(self, path):
+        """Merges partials of all processes into a snapshot at `path`,
+        saving fresh partials first while they run."""
+        with self.lock:
+            if self.workers:
+                replies = self.command('checkpoint')
+                self.partials = [partial for partials, stats, metrics in replies for partial in partials]
+            snapshots = [Snapshot(partial) for partial in self.partials]
+            try:
+                with SPANS.span('snapshot'):
+                    return gevent.get_hub().threadpool.apply(merge_snapshots, (snapshots, path))
+            finally:
+                for snapshot in snapshots:
+                    snapshot.close()
+
+
+def resident_memory():
+    """Resident set size of this process in bytes, 0 where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+
+class SnapshotRotation(object):
+    """Rotates snapshots of a long-running collector.
+
+    Everything collected is written to a new snapshot named after `path`
+    and the time every `interval` seconds, once the collected coverage
+    takes `max_size` bytes, or early once the process grows beyond
+    `max_memory` bytes. Rotated snapshots don't overlap, merging them adds
+    up their coverage.
+    """
+
+    check_interval = 1.0
+
+    def __init__(self, collector, path, interval=3600.0, max_size=0, max_memory=0):
+        self.collector = collector
+        self.path = path
+        self.interval = interval
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.rotated = time.time()
+        self.stopped = Event()
+        self.greenlet = None
+        self.snapshots = []
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.run)
+        return self
+
+    def next_path(self, now):
+        base, ext = os.path.splitext(self.path)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        path = '%s-%s%s' % (base, stamp, ext or '.snap')
+        sequence = 1
+        while os.path.exists(path):
+            sequence = sequence + 1
+            path = '%s-%s-%d%s' % (base, stamp, sequence, ext or '.snap')
+        return path
+
+    def reason(self, now):
+        """Why coverage should be rotated now, or None."""
+        if now - self.rotated >= self.interval:
+            return 'interval'
+        if self.max_size and self.collector.coverage.nbytes() >= self.max_size:
+            return 'size'
+        if self.max_memory and len(self.collector.coverage) and resident_memory() >= self.max_memory:
+            return 'memory'
+        return None
+
+    def rotate(self, reason):
+        now = time.time()
+        path = self.next_path(now)
+        reports = self.collector.stats['completed']
+        count = self.collector.rotate(path)
+        self.rotated = now
+        if count:
+            self.snapshots.append(path)
+            print "Rotated %d files to %s (%s), %d reports so far" % (count, path, reason, reports)
+        if reason == 'memory':
+            gc.collect()
+            if resident_memory() >= self.max_memory:
+                print "Still %dMB resident after rotating, raise the memory limit" % (resident_memory() / 1024 / 1024)
+        return count
+
+    def run(self):
+        while not self.stopped.wait(self.check_interval):
+            reason = self.reason(time.time())
+            if reason is not None:
+                self.rotate(reason)
+
+    def stop(self):
+        """Stops rotating and rotates what is left, stop the collector first."""
+        self.stopped.set()
+        if self.greenlet is not None:
+            self.greenlet.join()
+            self.greenlet = None
+        return self.rotate('stop')
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Index of the urls covering every line of a snapshot."""
+
+import bisect
+import os
+import mmap
+import struct
+from array import array
+from collections import defaultdict
+
+from walker.snapshot import Snapshot, read_array
+
+
+# Index layout, next to the snapshot it indexes as SNAPSHOT.index:
+#
+#   magic
+#   for every file of the snapshot: posting lists of urls covering each
+#   covered line, then the file's line directory: the number of lines, the
+#   lines and number + 1 offsets of their posting lists
+#   for every url: (file id, set id) of its reports, sorted by file
+#   number of urls + 1 offsets of these lists
+#   url ids ordered by url, to look a url up by bisection
+#   offsets of line directories of files
+#   INDEX_FOOTER, with the size and mtime of the snapshot indexed
+#
+# Posting lists are sorted url ids as varints of differences to the
+# previous id, the file ids of url lists are delta encoded the same way.
+# Offsets are unsigned 64 bit integers, everything is little-endian.
+INDEX_MAGIC = 'WLKIDX2\x00'
+
+
+INDEX_FOOTER = struct.Struct('<QQQIIQd8s')
+
+
+INDEX_OFFSET = struct.Struct('<Q')
+
+
+def encode_varints(values):
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return out
+
+
+def decode_varints(data):
+    values = []
+    value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift = shift + 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def encode_postings(ids):
+    """Sorted ids as varints of differences to the previous id."""
+    return encode_varints(id - last for id, last in zip(ids, [0] + list(ids[:-1])))
+
+
+def decode_postings(data):
+    ids = []
+    last = 0
+    for delta in decode_varints(data):
+        last = last + delta
+        ids.append(last)
+    return ids
+
+
+def write_index(snapshot, path):
+    """Writes the url and file:line index of a Snapshot to `path`."""
+    count = len(snapshot.url_bounds)
+    url_files = [array('I') for url in xrange(count)]
+    last_file = array('I', [0]) * count
+    directories = []
+    with open(path + '.tmp', 'wb') as f:
+        f.write(INDEX_MAGIC)
+        for id in xrange(len(snapshot)):
+            data = snapshot.section(id)
+            by_set = defaultdict(list)
+            for url, set_id in sorted(set(zip(data.urls, data.set_ids))):
+                by_set[set_id].append(url)
+                url_files[url].extend((id - last_file[url], set_id))
+                last_file[url] = id
+            postings = defaultdict(set)
+            for set_id, urls in by_set.items():
+                for line in data.sets[set_id]:
+                    postings[line].update(urls)
+
+            lines = array('I', sorted(postings))
+            offsets = []
+            for line in lines:
+                offsets.append(f.tell())
+                f.write(encode_postings(sorted(postings[line])))
+            offsets.append(f.tell())
+            directories.append(f.tell())
+            f.write(struct.pack('<I', len(lines)))
+            f.write(lines.tostring())
+            f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+
+        offsets = []
+        for files in url_files:
+            offsets.append(f.tell())
+            f.write(encode_varints(files))
+        offsets.append(f.tell())
+        url_files = last_file = None
+        offsets_at = f.tell()
+        for offset in offsets:
+            f.write(INDEX_OFFSET.pack(offset))
+        order_at = f.tell()
+        f.write(array('I', sorted(xrange(count), key=snapshot.url)).tostring())
+        directories_at = f.tell()
+        for offset in directories:
+            f.write(INDEX_OFFSET.pack(offset))
+        f.write(INDEX_FOOTER.pack(offsets_at, order_at, directories_at, count, len(snapshot),
+                                  len(snapshot.mm), snapshot.mtime, INDEX_MAGIC))
+    os.rename(path + '.tmp', path)
+
+
+class CoverageIndex(object):
+    """Lookups of urls covering a file:line and of files a url covers.
+
+    Reads SNAPSHOT.index written by write_index and the snapshot itself for
+    urls and lines, both memory mapped. Every lookup reads a few offsets
+    and one posting list.
+    """
+
+    def __init__(self, path):
+        self.snapshot = Snapshot(path)
+        with open(path + '.index', 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("%s.index is not an index" % path)
+        self.offsets_at, self.order_at, self.directories_at, urls, files, size, mtime, magic = \
+            INDEX_FOOTER.unpack_from(self.mm, len(self.mm) - INDEX_FOOTER.size)
+        if magic != INDEX_MAGIC:
+            raise ValueError("%s.index is truncated" % path)
+        if (urls, files) != (len(self.snapshot.url_bounds), len(self.snapshot)):
+            raise ValueError("%s.index is not of %s" % (path, path))
+        # a snapshot rewritten in place may keep its urls and files
+        if (size, mtime) != (len(self.snapshot.mm), self.snapshot.mtime):
+            raise ValueError("%s.index is older than %s" % (path, path))
+
+    def close(self):
+        self.mm.close()
+        self.snapshot.close()
+
+    def offset(self, table, i):
+        return INDEX_OFFSET.unpack_from(self.mm, table + i * INDEX_OFFSET.size)[0]
+
+    def url_id(self, url):
+        """Id of a url by bisection over urls in order, None when it wasn't walked."""
+        low, high = 0, len(self.snapshot.url_bounds)
+        while low < high:
+            middle = (low + high) // 2
+            id, = struct.unpack_from('<I', self.mm, self.order_at + middle * 4)
+            if self.snapshot.url(id) < url:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.snapshot.url_bounds):
+            id, = struct.unpack_from('<I', self.mm, self.order_at + low * 4)
+            if self.snapshot.url(id) == url:
+                return id
+        return None
+
+    def file_id(self, filename):
+        """Id of a file by name or by a unique suffix of its path."""
+        if filename in self.snapshot.ids:
+            return self.snapshot.ids[filename]
+        matches = [id for id, name in enumerate(self.snapshot.filenames) if name.endswith('/' + filename.lstrip('/'))]
+        if len(matches) > 1:
+            raise ValueError("%s matches %d files" % (filename, len(matches)))
+        return matches[0] if matches else None
+
+    def urls(self, filename, line):
+        """Urls covering a line of a file."""
+        id = self.file_id(filename)
+        if id is None:
+            return []
+        directory = self.offset(self.directories_at, id)
+        count, = struct.unpack_from('<I', self.mm, directory)
+        lines = read_array(self.mm, directory + 4, count)
+        i = bisect.bisect_left(lines, line)
+        if i == count or lines[i] != line:
+            return []
+        offsets = directory + 4 + count * 4
+        start, end = self.offset(offsets, i), self.offset(offsets, i + 1)
+        return [self.snapshot.url(url) for url in decode_postings(self.mm[start:end])]
+
+    def files(self, url):
+        """{filename: [line, ...]} a url covers."""
+        id = self.url_id(url)
+        if id is None:
+            return {}
+        start, end = self.offset(self.offsets_at, id), self.offset(self.offsets_at, id + 1)
+        covered = defaultdict(set)
+        values = decode_varints(self.mm[start:end])
+        file_id = 0
+        for delta, set_id in zip(values[::2], values[1::2]):
+            file_id = file_id + delta
+            covered[self.snapshot.filenames[file_id]].update(self.snapshot.line_set(file_id, set_id))
+        return dict((filename, sorted(int(line) for line in lines)) for filename, lines in covered.items())
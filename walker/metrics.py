@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Metrics, timing spans and profiles of walks."""
+
+import cProfile
+import os
+import signal
+import time
+from collections import defaultdict
+
+import ujson
+import gevent
+
+
+class Spans(object):
+    """Seconds spent in named spans of the hot paths and how often they ran.
+
+    Cheap enough to leave on: a span costs two time.time() calls and two
+    dict updates. Time spans with `with spans.span(name):` or add() seconds
+    measured elsewhere, like in a thread or a worker process.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def add(self, name, seconds, count=1):
+        self.seconds[name] = self.seconds[name] + seconds
+        self.counts[name] = self.counts[name] + count
+
+    def span(self, name):
+        return Span(self, name)
+
+    def metrics(self, prefix):
+        metrics = dict(('%s%s_seconds_total' % (prefix, name), seconds) for name, seconds in self.seconds.items())
+        metrics.update(('%s%s_calls_total' % (prefix, name), count) for name, count in self.counts.items())
+        return metrics
+
+    def summary(self):
+        return ", ".join("%s %3.3fs in %d" % (name, self.seconds[name], self.counts[name])
+                         for name in sorted(self.seconds)) or "none"
+
+
+class Span(object):
+    __slots__ = ('spans', 'name', 'started')
+
+    def __init__(self, spans, name):
+        self.spans = spans
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, exc, value, traceback):
+        self.spans.add(self.name, time.time() - self.started)
+
+
+# Spans of this process outside of ingest: highlight, write and snapshot.
+SPANS = Spans()
+
+
+class Profiler(object):
+    """Profiles of a walk saved to `directory` for --profile.
+
+    Between start() and stop() the stack running on the gevent loop is
+    sampled every `interval` seconds of CPU time, rooted at the greenlet
+    it runs in, and saved as collapsed stacks for flamegraph.pl. profile()
+    runs a function under cProfile and saves its pstats.
+    """
+
+    def __init__(self, directory, interval=0.005):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.handler = None
+
+    def start(self):
+        self.stacks = defaultdict(int)
+        self.handler = signal.signal(signal.SIGPROF, self.sample)
+        # restart system calls of native threads interrupted by samples
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def sample(self, signum, frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        current = gevent.getcurrent()
+        if current is gevent.get_hub():
+            frames.append('hub')
+        elif current.parent is None:
+            frames.append('main')
+        else:
+            run = getattr(current, '_run', None)
+            frames.append('greenlet %s' % getattr(run, '__name__', 'run'))
+        stack = ';'.join(reversed(frames))
+        self.stacks[stack] = self.stacks[stack] + 1
+
+    def stop(self, name):
+        """Stops sampling and saves samples to NAME.collapsed."""
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.handler or signal.SIG_DFL)
+        path = os.path.join(self.directory, name + '.collapsed')
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+        return path
+
+    def profile(self, name, func, *args, **kwargs):
+        """Returns func(*args, **kwargs) and saves its profile to NAME.pstats."""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            profile.dump_stats(os.path.join(self.directory, name + '.pstats'))
+
+
+class Metrics(object):
+    """Walk and ingest metrics as Prometheus text or JSON.
+
+    WalkStats and the collector's metrics() are only read when metrics are
+    rendered, requests and reports just bump counters. serve() answers
+    /metrics and /metrics.json while walking.
+    """
+
+    def __init__(self, stats, collector):
+        self.stats = stats
+        self.collector = collector
+        self.server = None
+
+    def to_dict(self):
+        requests = {}
+        for pattern, stats in self.stats.patterns.items():
+            requests[pattern] = {
+                'codes': dict((str(code), count) for code, count in stats.codes.items()),
+                'errors': stats.errors,
+                'bytes': stats.bytes,
+                'latency': {'buckets': [[str(bound), count] for bound, count in stats.latency.buckets()],
+                            'sum': stats.latency.sum},
+            }
+        return {
+            'elapsed': time.time() - self.stats.started,
+            'requests': requests,
+            'collector': self.counters(),
+        }
+
+    def counters(self):
+        counters = dict(self.collector.metrics())
+        counters.update(SPANS.metrics('span_'))
+        return counters
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append('# HELP walker_%s %s' % (name, help))
+            lines.append('# TYPE walker_%s %s' % (name, kind))
+
+        def sample(name, labels, value):
+            labels = ','.join('%s="%s"' % (label, prometheus_escape(text)) for label, text in labels)
+            lines.append('walker_%s%s %s' % (name, '{%s}' % labels if labels else '', value))
+
+        patterns = sorted(self.stats.patterns.items())
+        metric('requests_total', 'counter', 'Responses by url pattern and status code.')
+        for pattern, stats in patterns:
+            for code, count in sorted(stats.codes.items()):
+                sample('requests_total', [('pattern', pattern), ('code', str(code))], count)
+        metric('request_errors_total', 'counter', 'Requests failed without a response.')
+        for pattern, stats in patterns:
+            sample('request_errors_total', [('pattern', pattern)], stats.errors)
+        metric('response_bytes_total', 'counter', 'Size of response bodies.')
+        for pattern, stats in patterns:
+            sample('response_bytes_total', [('pattern', pattern)], stats.bytes)
+        metric('request_seconds', 'histogram', 'Request latency.')
+        for pattern, stats in patterns:
+            for bound, count in stats.latency.buckets():
+                sample('request_seconds_bucket', [('pattern', pattern), ('le', str(bound))], count)
+            sample('request_seconds_sum', [('pattern', pattern)], repr(stats.latency.sum))
+            sample('request_seconds_count', [('pattern', pattern)], sum(stats.latency.counts))
+        for name, value in sorted(self.counters().items()):
+            metric(name, 'counter' if name.endswith('_total') else 'gauge', name.replace('_', ' ').capitalize() + '.')
+            sample(name, [], repr(value) if isinstance(value, float) else value)
+        metric('elapsed_seconds', 'gauge', 'Seconds since the walk started.')
+        sample('elapsed_seconds', [], repr(time.time() - self.stats.started))
+        return '\n'.join(lines) + '\n'
+
+    def application(self, environ, start_response):
+        if environ['PATH_INFO'] == '/metrics':
+            body, content_type = self.prometheus(), 'text/plain; version=0.0.4'
+        elif environ['PATH_INFO'] == '/metrics.json':
+            body, content_type = ujson.encode(self.to_dict()), 'application/json'
+        else:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not found\n']
+        start_response('200 OK', [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def serve(self, port, host='127.0.0.1'):
+        from gevent.pywsgi import WSGIServer
+        self.server = WSGIServer((host, port), self.application, log=None)
+        self.server.start()
+        return self
+
+    def close(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+    def save(self, path):
+        """Writes JSON to *.json paths and Prometheus text to others."""
+        with open(path, 'w') as f:
+            f.write(ujson.encode(self.to_dict()) if path.endswith('.json') else self.prometheus())
+
+
+def prometheus_escape(text):
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Forked worker processes talking over socket pairs."""
+
+import cPickle
+import os
+import socket
+import struct
+from collections import deque
+
+import gevent
+import gevent.os
+import gevent.socket
+from gevent.event import AsyncResult
+from gevent.monkey import get_original
+from gevent.queue import Queue
+
+
+# Messages between processes and stream reports are prefixed with their length.
+LENGTH = struct.Struct('!I')
+
+
+class ProcessPool(object):
+    """Run a function over items in forked worker processes.
+
+    Every worker talks to a greenlet of the parent over a socket pair,
+    items and results are sent as length-prefixed pickles. This stands in
+    for multiprocessing.Pool, whose helper threads become greenlets under
+    patch_all and block the hub while they wait on its pipes. With a
+    `profiler` every worker saves its profile as NAME-workerN.pstats.
+    """
+
+    def __init__(self, func, processes, profiler=None, name='pool'):
+        self.func = func
+        self.processes = processes
+        self.profiler = profiler
+        self.name = name
+        self.workers = []
+
+    def start(self):
+        for i in xrange(self.processes):
+            parent, child = gevent.socket.socketpair()
+            pid = gevent.os.fork_and_watch()
+            if pid == 0:
+                try:
+                    parent.close()
+                    child = blocking_socket(child)
+                    if self.profiler is not None:
+                        self.profiler.profile('%s-worker%d' % (self.name, i + 1), self.work, child)
+                    else:
+                        self.work(child)
+                finally:
+                    os._exit(0)
+            child.close()
+            self.workers.append((pid, parent))
+
+    def work(self, sock):
+        rfile = sock.makefile('rb', -1)
+        try:
+            while True:
+                item = recv_message(rfile)
+                if item is None:
+                    break
+                try:
+                    send_message(sock, (True, self.func(item)))
+                except Exception, e:
+                    send_message(sock, (False, "%s: %s" % (e.__class__.__name__, e)))
+        finally:
+            rfile.close()
+            sock.close()
+
+    def feed(self, sock, tasks):
+        rfile = sock.makefile('rb', -1)
+        try:
+            for item, result in tasks:
+                try:
+                    send_message(sock, item)
+                    reply = recv_message(rfile)
+                except socket.error:
+                    reply = None
+                if reply is None:
+                    # the worker died, fail its item and the queued ones so imap() doesn't wait forever
+                    error = RuntimeError("%s worker exited" % self.name)
+                    result.set_exception(error)
+                    for item, result in tasks:
+                        result.set_exception(error)
+                    return
+                ok, value = reply
+                if ok:
+                    result.set(value)
+                else:
+                    result.set_exception(RuntimeError(value))
+            send_message(sock, None)
+        finally:
+            rfile.close()
+            sock.close()
+
+    def imap(self, items):
+        """Yields func(item) for every item, in order of items."""
+        if self.processes < 2:
+            for item in items:
+                yield self.func(item)
+            return
+
+        self.start()
+        tasks = Queue(self.processes * 2)
+        feeders = [gevent.spawn(self.feed, sock, tasks) for pid, sock in self.workers]
+        window = deque()
+        try:
+            for item in items:
+                result = AsyncResult()
+                tasks.put((item, result))
+                window.append(result)
+                if len(window) > self.processes * 2:
+                    yield window.popleft().get()
+            for feeder in feeders:
+                tasks.put(StopIteration)
+            while window:
+                yield window.popleft().get()
+        finally:
+            gevent.killall(feeders)
+            for pid, sock in self.workers:
+                sock.close()
+                gevent.os.waitpid(pid, 0)
+            self.workers = []
+
+
+def blocking_socket(sock):
+    """A blocking stdlib socket in place of the gevent socket `sock`.
+
+    A forked child inherits the parent's greenlets, waiting on a gevent
+    socket switches to the hub and runs them. Waiting on this one doesn't.
+    """
+    blocking = get_original('socket', 'fromfd')(sock.fileno(), socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.close()
+    blocking.setblocking(1)
+    return blocking
+
+
+def send_message(sock, obj):
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+
+def recv_message(rfile):
+    """Next message read from `rfile`, None once the other end closed or
+    died, also in the middle of a message."""
+    header = rfile.read(LENGTH.size)
+    if len(header) < LENGTH.size:
+        return None
+    length, = LENGTH.unpack(header)
+    data = rfile.read(length)
+    if len(data) < length:
+        return None
+    try:
+        return cPickle.loads(data)
+    except (EOFError, cPickle.UnpicklingError):
+        return None
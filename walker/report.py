@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""HTML coverage report with highlighted PHP sources.
+
+Pygments is imported by the first file highlighted, not with this module.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import md5, sha1
+
+import ujson
+
+from walker.metrics import SPANS
+from walker.pool import ProcessPool
+from walker.snapshot import load_coverage
+from walker.templates import ROW, HEADER, HTML, MENU_FILE, MENU_DIR, FILE, INDEX_DIR, INDEX_LINK
+
+
+def highlight_lines(source):
+    """Highlighted HTML of every source line, without coverage."""
+    from pygments.formatters import HtmlFormatter
+    formatter = HtmlFormatter(nowrap=True)
+    return [value for t, value in formatter._format_lines(php_lexer().get_tokens(source)) if t == 1]
+
+
+def render_rows(lines, covered):
+    """Table rows of the FILE template, from highlight_lines() output."""
+    return u"".join(ROW % (' class="highlight"' if i + 1 in covered else '', i + 1, value)
+                    for i, value in enumerate(lines))
+
+
+class RenderCache(object):
+    """Highlighted source lines kept on disk, keyed by a hash of the source.
+
+    Entries are zlib compressed JSON lists of lines, so coverage of every
+    run is applied to them with render_rows(). A hit touches the entry,
+    prune() removes least recently used entries while the cache is bigger
+    than `max_size` bytes.
+    """
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, source):
+        import pygments
+        key = sha1("%s:php:%s" % (pygments.__version__, source)).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, source):
+        path = self.path(source)
+        try:
+            with open(path, 'rb') as f:
+                lines = ujson.decode(zlib.decompress(f.read()))
+            os.utime(path, None)
+        except (IOError, OSError, zlib.error, ValueError):
+            return None
+        return lines
+
+    def put(self, source, lines):
+        path = self.path(source)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # made by another worker
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(zlib.compress(ujson.encode(lines)))
+        os.rename(tmp, path)
+
+    def prune(self):
+        """Evicts least recently used entries, returns how many."""
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        evicted = 0
+        for mtime, length, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.unlink(path)
+            size = size - length
+            evicted = evicted + 1
+        return evicted
+
+
+_lexer = None
+
+
+def php_lexer():
+    global _lexer
+    if _lexer is None:
+        from pygments.lexers import get_lexer_by_name
+        _lexer = get_lexer_by_name("php", stripall=True, encoding="utf-8")
+    return _lexer
+
+
+def render_file(task):
+    """Highlights one source file, runs in report worker processes.
+
+    Takes (filename, covered lines, prefix, RenderCache or None) and returns
+    the values for the FILE and MENU templates and the seconds highlighting
+    took, or None when the file can't be read.
+    """
+    filename, lines_cov, prefix, cache = task
+    try:
+        source = open(filename).read()
+    except (IOError, OSError), e:
+        print e
+        return None
+    sloc = len(source.split('\n'))
+    hits = len(lines_cov)
+
+    lines = cache.get(source) if cache is not None else None
+    cached = lines is not None
+    started = time.time()
+    if not cached:
+        lines = highlight_lines(source)
+        if cache is not None:
+            cache.put(source, lines)
+
+    return {
+        'table': render_rows(lines, set(lines_cov)),
+        'cached': cached,
+        'seconds': time.time() - started,
+        'file_id': md5(filename).hexdigest(),
+        'filename': filename.replace(prefix, ''),
+        'basename': os.path.basename(filename),
+        'dirname': os.path.dirname(filename.replace(prefix, '')),
+        'sloc': sloc,
+        'hits': hits,
+        'misses': sloc - hits,
+        'percentage': (float(hits) / float(sloc)) * 100.0
+    }
+
+
+def percentage(hits, sloc):
+    return (float(hits) / float(max(sloc, 1))) * 100.0
+
+
+def menu_entry(result):
+    if result['basename'] != result['filename']:
+        return MENU_DIR % result
+    return MENU_FILE % result
+
+
+def write_page(results, output, prefix, totals):
+    """Writes the whole report to a single page.
+
+    FILE blocks go to a temporary file as soon as they are rendered and are
+    copied to the page after the overview, which needs totals of all files.
+    """
+    menu = []
+    with tempfile.TemporaryFile() as files:
+        for result in results:
+            with SPANS.span('write'):
+                result['href'] = '#' + result['file_id']
+                if menu:
+                    files.write('\n\n')
+                menu.append(menu_entry(result))
+                files.write((FILE % result).encode("utf-8", 'ignore'))
+
+        top, bottom = HTML.split('%(files)s')
+        with SPANS.span('write'), open(output, 'w+') as f:
+            f.write(HEADER.encode("utf-8", 'ignore'))
+            f.write((top % {
+                'menu': '\n\n'.join(menu),
+                'title': "Coverage for %s" % prefix,
+                'sloc': totals['sloc'],
+                'hits': totals['hits'],
+                'misses': totals['sloc'] - totals['hits'],
+                'percentage': percentage(totals['hits'], totals['sloc'])
+            }).encode("utf-8", 'ignore'))
+            files.seek(0)
+            shutil.copyfileobj(files, f)
+            f.write(bottom.encode("utf-8", 'ignore'))
+
+
+def write_pages(results, output, prefix, totals, split='file'):
+    """Writes the report to the `output` directory, a page per file or per directory.
+
+    Every page is written as soon as its files are rendered. index.html
+    links to all of them and lists coverage of every directory.
+    """
+    pages = os.path.join(output, 'pages')
+    if not os.path.isdir(pages):
+        os.makedirs(pages)
+
+    menu = []
+    dirs = OrderedDict()
+    page = {'id': None, 'title': None, 'menu': [], 'files': [], 'sloc': 0, 'hits': 0}
+
+    def write(page):
+        if page['id'] is None:
+            return
+        with SPANS.span('write'), open(os.path.join(pages, page['id'] + '.html'), 'w+') as f:
+            f.write(HEADER.encode("utf-8", 'ignore'))
+            f.write((HTML % {
+                'files': '\n\n'.join(page['files']),
+                'menu': INDEX_LINK + '\n\n'.join(page['menu']),
+                'title': "Coverage for %s" % page['title'],
+                'sloc': page['sloc'],
+                'hits': page['hits'],
+                'misses': page['sloc'] - page['hits'],
+                'percentage': percentage(page['hits'], page['sloc'])
+            }).encode("utf-8", 'ignore'))
+
+    for result in results:
+        if split == 'file':
+            page_id, title = result['file_id'], result['filename']
+        else:
+            page_id, title = md5(result['dirname'].encode('utf-8')).hexdigest(), result['dirname'] or '/'
+        if page_id != page['id']:
+            write(page)
+            page = {'id': page_id, 'title': title, 'menu': [], 'files': [], 'sloc': 0, 'hits': 0}
+        page['sloc'] = page['sloc'] + result['sloc']
+        page['hits'] = page['hits'] + result['hits']
+        page['files'].append(FILE % result)
+
+        result['href'] = '#' + result['file_id']
+        page['menu'].append(menu_entry(result))
+        result['href'] = 'pages/%s.html#%s' % (page_id, result['file_id'])
+        menu.append(menu_entry(result))
+
+        entry = dirs.setdefault(result['dirname'], {'dirname': result['dirname'] or '/', 'sloc': 0, 'hits': 0,
+                                                    'href': result['href']})
+        entry['sloc'] = entry['sloc'] + result['sloc']
+        entry['hits'] = entry['hits'] + result['hits']
+    write(page)
+
+    entries = []
+    for dirname in sorted(dirs):
+        entry = dirs[dirname]
+        entry['percentage'] = percentage(entry['hits'], entry['sloc'])
+        entries.append(INDEX_DIR % entry)
+
+    with SPANS.span('write'), open(os.path.join(output, 'index.html'), 'w+') as f:
+        f.write(HEADER.encode("utf-8", 'ignore'))
+        f.write((HTML % {
+            'files': '<ul>%s</ul>' % ''.join(entries),
+            'menu': '\n\n'.join(menu),
+            'title': "Coverage for %s" % prefix,
+            'sloc': totals['sloc'],
+            'hits': totals['hits'],
+            'misses': totals['sloc'] - totals['hits'],
+            'percentage': percentage(totals['hits'], totals['sloc'])
+        }).encode("utf-8", 'ignore'))
+
+
+def generate_report(coverage, output='report.html', jobs=1, cache=None, split=None, profiler=None):
+    """Writes the HTML report, highlighting source files in `jobs` processes.
+
+    Highlighted sources are reused from and saved to `cache`, a RenderCache.
+    With `split` set to 'file' or 'dir' `output` is a directory that gets an
+    index page and a page per file or per directory. With a `profiler` the
+    highlighting processes save their profiles.
+    """
+    if isinstance(coverage, basestring):
+        coverage = load_coverage(coverage)
+
+    prefix = os.path.commonprefix(coverage.keys())
+    totals = {'files': 0, 'sloc': 0, 'hits': 0, 'cached': 0}
+
+    filenames = sorted(coverage.keys(), reverse=True)
+    if split == 'dir':
+        filenames.sort(key=os.path.dirname)
+    tasks = ((filename, sorted([int(str(l)) for l in coverage[filename].keys()]), prefix, cache)
+             for filename in filenames)
+
+    def rendered(results):
+        for result in results:
+            if result is None:
+                continue
+            totals['files'] = totals['files'] + 1
+            totals['sloc'] = totals['sloc'] + result['sloc']
+            totals['hits'] = totals['hits'] + result['hits']
+            totals['cached'] = totals['cached'] + result['cached']
+            if not result['cached']:
+                SPANS.add('highlight', result['seconds'])
+            yield result
+
+    results = rendered(ProcessPool(render_file, jobs, profiler, 'report').imap(tasks))
+    if split:
+        write_pages(results, output, prefix, totals, split)
+    else:
+        write_page(results, output, prefix, totals)
+
+    if cache is not None:
+        print "Render cache: %d hits, %d misses, %d evicted" % (
+            totals['cached'], totals['files'] - totals['cached'], cache.prune())
+
+
+def html_escape(text):
+    """Produce entities within text."""
+    html_escape_table = {"&": "&amp;", '"': "&quot;", "'": "&apos;", ">": "&gt;", "<": "&lt;", "\t": "    "}
+    return "".join(html_escape_table.get(c, c) for c in text)
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary coverage snapshots, merging and minimizing them."""
+
+import os
+import heapq
+import itertools
+import mmap
+import struct
+from array import array
+from collections import defaultdict
+from hashlib import sha1
+
+import ujson
+
+from walker.store import StringTable, CoverageStore, CoverageDatabase
+
+
+# Snapshot layout, all offsets are from the start of the file:
+#
+#   magic
+#   a section per file in filename order: SNAPSHOT_SECTION with the number of
+#   covered lines, distinct sets of lines and reports, then arrays of lines,
+#   hits, set boundaries, set lines, report url ids and report set ids
+#   url table, file table: count, count + 1 boundaries, utf-8 strings
+#   index: SNAPSHOT_INDEX with offset and size of every section
+#   SNAPSHOT_FOOTER
+#
+# Arrays are unsigned ints in machine byte order, like line sets in the
+# database. The footer is written last, so a snapshot can be streamed out
+# file by file and a truncated one is detected.
+SNAPSHOT_MAGIC = 'WLKSNAP1'
+
+
+SNAPSHOT_SECTION = struct.Struct('<III')
+
+
+SNAPSHOT_INDEX = struct.Struct('<QI')
+
+
+SNAPSHOT_FOOTER = struct.Struct('<QQQII8s')
+
+
+SNAPSHOT_LINES_ONLY = 1
+
+
+def read_array(buf, offset, count, typecode='I'):
+    result = array(typecode)
+    result.fromstring(buf[offset:offset + count * result.itemsize])
+    return result
+
+
+class SnapshotWriter(object):
+    """Streams a coverage snapshot to `path`.
+
+    Files have to be added in filename order. Url ids in reports refer to
+    `urls`, a StringTable, which is written out on close(). The snapshot is
+    written to a temporary file renamed to `path` on close().
+    """
+
+    def __init__(self, path, urls=None, lines_only=False):
+        self.path = path
+        self.urls = StringTable() if urls is None else urls
+        self.lines_only = lines_only
+        self.files = []
+        self.index = []
+        self.f = open(path + '.tmp', 'wb')
+        self.f.write(SNAPSHOT_MAGIC)
+
+    def add(self, filename, lines, hits, sets=(), reports=()):
+        """Adds coverage of a file.
+
+        `lines` and `hits` are arrays of covered lines in ascending order and
+        their hits, `sets` a list of distinct sets of lines packed like
+        FileCoverage.lines and `reports` a list of (url id, set id).
+        """
+        if self.files and filename <= self.files[-1]:
+            raise ValueError("%s added after %s" % (filename, self.files[-1]))
+        bounds = array('I', [0])
+        for packed in sets:
+            bounds.append(bounds[-1] + len(packed) / bounds.itemsize)
+        urls = array('I', [url for url, set_id in reports])
+        set_ids = array('I', [set_id for url, set_id in reports])
+
+        offset = self.f.tell()
+        self.f.write(SNAPSHOT_SECTION.pack(len(lines), len(sets), len(reports)))
+        self.f.write(array('I', lines).tostring())
+        self.f.write(array('I', hits).tostring())
+        self.f.write(bounds.tostring())
+        for packed in sets:
+            self.f.write(packed)
+        self.f.write(urls.tostring())
+        self.f.write(set_ids.tostring())
+        self.files.append(filename)
+        self.index.append(SNAPSHOT_INDEX.pack(offset, self.f.tell() - offset))
+
+    def write_strings(self, strings):
+        offset = self.f.tell()
+        bounds = array('I', [0])
+        encoded = []
+        for string in strings:
+            if isinstance(string, unicode):
+                string = string.encode('utf-8')
+            encoded.append(string)
+            if bounds[-1] + len(string) > 0xffffffff:
+                raise ValueError("strings of %s don't fit in 4GB" % self.path)
+            bounds.append(bounds[-1] + len(string))
+        self.f.write(struct.pack('<I', len(encoded)))
+        self.f.write(bounds.tostring())
+        for string in encoded:
+            self.f.write(string)
+        return offset
+
+    def close(self):
+        urls_at = self.write_strings(self.urls.strings)
+        files_at = self.write_strings(self.files)
+        index_at = self.f.tell()
+        self.f.write(''.join(self.index))
+        self.f.write(SNAPSHOT_FOOTER.pack(urls_at, files_at, index_at, len(self.files),
+                                          SNAPSHOT_LINES_ONLY if self.lines_only else 0, SNAPSHOT_MAGIC))
+        self.f.close()
+        os.rename(self.path + '.tmp', self.path)
+
+
+class StringBounds(object):
+    """(start, end) offsets of strings of a snapshot string table."""
+
+    def __init__(self, base, bounds):
+        self.base = base
+        self.bounds = bounds
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def __getitem__(self, id):
+        if not 0 <= id < len(self.bounds) - 1:
+            raise IndexError(id)
+        return self.base + self.bounds[id], self.base + self.bounds[id + 1]
+
+    def __iter__(self):
+        for id in xrange(len(self)):
+            yield self[id]
+
+
+class SnapshotFile(object):
+    """Coverage of a file read from a snapshot, `sets` are arrays of lines."""
+
+    __slots__ = ('lines', 'hits', 'sets', 'urls', 'set_ids')
+
+    def records(self):
+        """Yields (url id, lines) for every report."""
+        for url, set_id in zip(self.urls, self.set_ids):
+            yield url, self.sets[set_id]
+
+
+class Snapshot(object):
+    """Read only coverage snapshot written by SnapshotWriter.
+
+    The file is memory mapped, only filenames are read on open. Coverage of
+    a file is read when asked for, urls one by one, so a snapshot can be
+    passed to generate_report as is.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mtime = os.fstat(f.fileno()).st_mtime
+        if len(self.mm) < len(SNAPSHOT_MAGIC) + SNAPSHOT_FOOTER.size or \
+                self.mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("%s is not a snapshot" % path)
+        urls_at, files_at, self.index_at, count, flags, magic = SNAPSHOT_FOOTER.unpack_from(
+            self.mm, len(self.mm) - SNAPSHOT_FOOTER.size)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("%s is truncated" % path)
+        self.lines_only = bool(flags & SNAPSHOT_LINES_ONLY)
+        self.filenames = [self.mm[start:end] for start, end in self.strings(files_at)]
+        self.ids = dict((filename, id) for id, filename in enumerate(self.filenames))
+        self.url_bounds = self.strings(urls_at)
+
+    def strings(self, offset):
+        """(start, end) of every string in the table at `offset`."""
+        count, = struct.unpack_from('<I', self.mm, offset)
+        bounds = read_array(self.mm, offset + 4, count + 1)
+        base = offset + 4 + len(bounds) * bounds.itemsize
+        return StringBounds(base, bounds)
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __contains__(self, filename):
+        return filename in self.ids
+
+    def keys(self):
+        return list(self.filenames)
+
+    def url(self, id):
+        start, end = self.url_bounds[id]
+        return self.mm[start:end]
+
+    def file(self, filename):
+        return self.section(self.ids[filename])
+
+    def section(self, id):
+        offset, size = SNAPSHOT_INDEX.unpack_from(self.mm, self.index_at + id * SNAPSHOT_INDEX.size)
+        nlines, nsets, nreports = SNAPSHOT_SECTION.unpack_from(self.mm, offset)
+        data = SnapshotFile()
+        offset = offset + SNAPSHOT_SECTION.size
+        data.lines = read_array(self.mm, offset, nlines)
+        data.hits = read_array(self.mm, offset + nlines * 4, nlines)
+        offset = offset + nlines * 8
+        bounds = read_array(self.mm, offset, nsets + 1)
+        offset = offset + (nsets + 1) * 4
+        data.sets = [read_array(self.mm, offset + start * 4, end - start) for start, end in zip(bounds, bounds[1:])]
+        offset = offset + bounds[-1] * 4
+        data.urls = read_array(self.mm, offset, nreports)
+        data.set_ids = read_array(self.mm, offset + nreports * 4, nreports)
+        return data
+
+    def line_set(self, id, set_id):
+        """Lines of one set of a file, without reading the rest of its section."""
+        offset, size = SNAPSHOT_INDEX.unpack_from(self.mm, self.index_at + id * SNAPSHOT_INDEX.size)
+        nlines, nsets, nreports = SNAPSHOT_SECTION.unpack_from(self.mm, offset)
+        offset = offset + SNAPSHOT_SECTION.size + nlines * 8
+        start, end = read_array(self.mm, offset + set_id * 4, 2)
+        return read_array(self.mm, offset + (nsets + 1) * 4 + start * 4, end - start)
+
+    def __getitem__(self, filename):
+        data = self.file(filename)
+        return dict((int(line), int(count)) for line, count in zip(data.lines, data.hits))
+
+    def queries(self, filename):
+        """{line: [query, ...]} of a file."""
+        lines = defaultdict(list)
+        for url, covered in self.file(filename).records():
+            query = self.url(url)
+            for line in covered:
+                lines[int(line)].append(query)
+        return dict(lines)
+
+    def to_dict(self, queries=False):
+        if queries and not self.lines_only:
+            return dict((filename, self.queries(filename)) for filename in self.filenames)
+        return dict((filename, self[filename]) for filename in self.filenames)
+
+
+def snapshot_file(writer, filename, hits, queries=None):
+    """Adds a file to a SnapshotWriter from {line: hits} and {line: [query, ...]}."""
+    covered = sorted((int(line), int(count)) for line, count in hits.items() if count)
+    by_query = defaultdict(list)
+    for line, urls in sorted((int(line), urls) for line, urls in (queries or {}).items()):
+        for query in urls:
+            lines = by_query[query]
+            if not lines or lines[-1] != line:
+                lines.append(line)
+
+    sets, index, reports = [], {}, []
+    for query, lines in by_query.items():
+        packed = array('I', lines).tostring()
+        set_id = index.get(packed)
+        if set_id is None:
+            set_id = index[packed] = len(sets)
+            sets.append(packed)
+        reports.append((writer.urls.intern(query), set_id))
+    reports.sort()
+    writer.add(filename, [line for line, count in covered], [count for line, count in covered], sets, reports)
+
+
+def write_snapshot(coverage, path):
+    """Writes a CoverageStore, a CoverageDatabase, a Snapshot or
+    generate_report's dict to a snapshot at `path`."""
+    if isinstance(coverage, CoverageStore):
+        writer = SnapshotWriter(path, coverage.urls, coverage.lines_only)
+        for filename, file_id in sorted((coverage.files[file_id], file_id) for file_id in coverage.coverage):
+            data = coverage.coverage[file_id]
+            writer.add(filename,
+                       array('I', (line for line, count in enumerate(data.hits) if count)),
+                       array('I', (count for count in data.hits if count)),
+                       data.lines, zip(data.urls, data.sets))
+        writer.close()
+        return len(coverage)
+
+    writer = SnapshotWriter(path, lines_only=getattr(coverage, 'lines_only', False))
+    filenames = sorted(coverage.keys())
+    for filename in filenames:
+        lines = coverage[filename]
+        if hasattr(coverage, 'queries'):
+            snapshot_file(writer, filename, lines, coverage.queries(filename))
+        elif any(isinstance(urls, list) for urls in lines.values()):
+            snapshot_file(writer, filename, dict((line, len(urls)) for line, urls in lines.items()), lines)
+        else:
+            snapshot_file(writer, filename, lines)
+    writer.close()
+    return len(filenames)
+
+
+def merge_snapshots(snapshots, path):
+    """Merges Snapshots into a new one at `path` and returns the number of files.
+
+    Files of all snapshots are merged in filename order, one at a time:
+    hits are added up, reports are kept and distinct sets of lines are
+    stored once. The result doesn't depend on how inputs are grouped, so
+    merged snapshots can be merged again.
+    """
+    writer = SnapshotWriter(path, lines_only=all(snapshot.lines_only for snapshot in snapshots))
+    urls = [array('I', (writer.urls.intern(snapshot.url(url)) for url in xrange(len(snapshot.url_bounds))))
+            for snapshot in snapshots]
+    files = heapq.merge(*[itertools.izip(snapshot.filenames, itertools.repeat(i))
+                          for i, snapshot in enumerate(snapshots)])
+    count = 0
+    for filename, parts in itertools.groupby(files, key=lambda item: item[0]):
+        hits = defaultdict(int)
+        sets, index, reports = [], {}, []
+        for filename, i in parts:
+            data = snapshots[i].section(snapshots[i].ids[filename])
+            for line, hit in zip(data.lines, data.hits):
+                hits[line] = hits[line] + hit
+            set_ids = []
+            for lines in data.sets:
+                packed = lines.tostring()
+                set_id = index.get(packed)
+                if set_id is None:
+                    set_id = index[packed] = len(sets)
+                    sets.append(packed)
+                set_ids.append(set_id)
+            reports.extend((urls[i][url], set_ids[set_id]) for url, set_id in zip(data.urls, data.set_ids))
+        reports.sort()
+        lines = sorted(hits)
+        writer.add(filename, lines, [hits[line] for line in lines], sets, reports)
+        count = count + 1
+    writer.close()
+    return count
+
+
+def cover_urls(snapshot):
+    """Picks a small set of urls covering every line the urls of a Snapshot cover.
+
+    Lazy greedy set cover: urls wait in a heap by the number of new lines
+    they covered when last looked at, which can only go down, so the top
+    url is taken once its recounted gain still beats the next one.
+    Returns url ids in the order they were picked and the number of lines.
+    """
+    url_lines = [array('I') for url in xrange(len(snapshot.url_bounds))]
+    count = 0
+    for id in xrange(len(snapshot)):
+        data = snapshot.section(id)
+        position = dict((line, count + i) for i, line in enumerate(data.lines))
+        sets = [array('I', [position[line] for line in lines]) for lines in data.sets]
+        for url, set_id in zip(data.urls, data.set_ids):
+            url_lines[url].extend(sets[set_id])
+        count = count + len(data.lines)
+
+    heap = []
+    for url, lines in enumerate(url_lines):
+        if lines:
+            url_lines[url] = array('I', sorted(set(lines)))
+            heap.append((-len(url_lines[url]), url))
+    heapq.heapify(heap)
+
+    covered = bytearray(count)
+    picked = []
+    while heap:
+        gain, url = heapq.heappop(heap)
+        lines = url_lines[url] = array('I', [line for line in url_lines[url] if not covered[line]])
+        if not lines:
+            continue
+        if heap and len(lines) < -heap[0][0]:
+            heapq.heappush(heap, (-len(lines), url))
+            continue
+        for line in lines:
+            covered[line] = 1
+        url_lines[url] = None
+        picked.append(url)
+    return picked, sum(covered)
+
+
+class SourceManifest(object):
+    """Modification time, size and sha1 of the source files of a snapshot.
+
+    Kept as JSON in SNAPSHOT.manifest. A file whose mtime and size match
+    the manifest isn't read again, otherwise its sha1 tells if it changed.
+    """
+
+    def __init__(self, path):
+        self.path = path + '.manifest'
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.files = dict((filename, tuple(entry)) for filename, entry in ujson.decode(f.read()).items())
+
+    def stat(self, filename):
+        """(mtime in ms, size, sha1) of a file as it is now, None when it's gone."""
+        try:
+            st = os.stat(filename)
+            entry = self.files.get(filename)
+            if entry is not None and entry[:2] == (int(st.st_mtime * 1000), st.st_size):
+                return entry
+            with open(filename, 'rb') as f:
+                return int(st.st_mtime * 1000), st.st_size, sha1(f.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+
+    def changed(self, filenames):
+        """Files that are gone or have other contents than in the manifest,
+        files the manifest doesn't know count as changed."""
+        changed = set()
+        for filename in filenames:
+            entry = self.files.get(filename)
+            current = self.stat(filename)
+            if entry is None or current is None or current[1:] != entry[1:]:
+                changed.add(filename)
+        return changed
+
+    def update(self, filenames):
+        self.files = dict((filename, entry) for filename, entry in
+                          ((filename, self.stat(filename)) for filename in filenames) if entry is not None)
+        return self
+
+    def save(self):
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(ujson.encode(self.files))
+        os.rename(self.path + '.tmp', self.path)
+
+
+def rewalk_urls(snapshot, filenames):
+    """Ids of urls whose reports covered any of `filenames`, read from the
+    reports of just these files."""
+    urls = set()
+    for filename in filenames:
+        urls.update(snapshot.file(filename).urls)
+    return urls
+
+
+def carry_forward(snapshot, changed, urls, path):
+    """Writes coverage of `snapshot` still valid after `changed` files changed
+    and `urls`, a set of url ids, were walked again to a snapshot at `path`.
+
+    Changed files are left out, reports of the urls are dropped from all
+    other files and hits of their lines go down by one per dropped report.
+    Merged with a snapshot of the new walk it makes a full one again.
+    """
+    writer = SnapshotWriter(path, StringTable(), snapshot.lines_only)
+    for url in xrange(len(snapshot.url_bounds)):
+        writer.urls.intern(snapshot.url(url))
+    for id, filename in enumerate(snapshot.filenames):
+        if filename in changed:
+            continue
+        data = snapshot.section(id)
+        hits = dict(zip(data.lines, data.hits))
+        sets, index, reports = [], {}, []
+        for url, set_id in zip(data.urls, data.set_ids):
+            if url in urls:
+                for line in data.sets[set_id]:
+                    hits[line] = hits[line] - 1
+                continue
+            if set_id not in index:
+                index[set_id] = len(sets)
+                sets.append(data.sets[set_id].tostring())
+            reports.append((url, index[set_id]))
+        lines = sorted(line for line, count in hits.items() if count > 0)
+        if lines:
+            writer.add(filename, lines, [hits[line] for line in lines], sets, reports)
+    writer.close()
+
+
+def load_coverage(path):
+    """Coverage from a snapshot, a database or a JSON file with generate_report's dict."""
+    with open(path, 'rb') as f:
+        magic = f.read(16)
+    if magic.startswith(SNAPSHOT_MAGIC):
+        return Snapshot(path)
+    if magic == 'SQLite format 3\x00':
+        return CoverageDatabase(path)
+    with open(path, 'rb') as f:
+        return ujson.decode(f.read())
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coverage collected in memory and in SQLite databases."""
+
+import sqlite3
+from array import array
+from collections import defaultdict
+from hashlib import md5
+
+
+class StringTable(object):
+    """Intern strings to consecutive integer ids."""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, id):
+        return self.strings[id]
+
+    def intern(self, string):
+        id = self.ids.get(string)
+        if id is None:
+            id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return id
+
+
+class FileCoverage(object):
+    """Coverage of a single file.
+
+    `hits` is indexed by line number and counts reports that executed the
+    line. Unless only lines are collected every report also appends its url
+    id to `urls` and the id of its set of lines to `sets`. Most urls execute
+    one of a few distinct sets of lines of a file, so every distinct set is
+    kept once in `lines`, packed as a string of unsigned ints.
+    """
+
+    __slots__ = ('hits', 'urls', 'sets', 'lines', 'index')
+
+    def __init__(self):
+        self.hits = array('I')
+        self.urls = array('I')
+        self.sets = array('I')
+        self.lines = []
+        self.index = {}
+
+    def add(self, lines, url=None):
+        hits = self.hits
+        size = lines[-1] + 1
+        if size > len(hits):
+            hits.extend(array('I', [0]) * (size - len(hits)))
+        for line in lines:
+            hits[line] = hits[line] + 1
+        if url is not None:
+            packed = array('I', lines).tostring()
+            set_id = self.index.get(packed)
+            if set_id is None:
+                set_id = self.index[packed] = len(self.lines)
+                self.lines.append(packed)
+            self.urls.append(url)
+            self.sets.append(set_id)
+
+    def line_set(self, set_id):
+        lines = array('I')
+        lines.fromstring(self.lines[set_id])
+        return lines
+
+    def records(self):
+        """Yields (url id, lines) for every report."""
+        sets = [self.line_set(set_id) for set_id in xrange(len(self.lines))]
+        for url, set_id in zip(self.urls, self.sets):
+            yield url, sets[set_id]
+
+    def covered(self):
+        return [line for line, count in enumerate(self.hits) if count]
+
+    def nbytes(self):
+        return (sum(len(a) * a.itemsize for a in (self.hits, self.urls, self.sets)) +
+                sum(len(packed) for packed in self.lines))
+
+
+class CoverageStore(object):
+    """Compact coverage storage.
+
+    Filenames and urls are interned, line data of every file lives in a few
+    flat arrays of FileCoverage instead of a dict of lists of url strings.
+    """
+
+    def __init__(self, lines_only=False):
+        self.lines_only = lines_only
+        self.files = StringTable()
+        self.urls = StringTable()
+        self.coverage = {}
+        self.flushed_files = 0
+        self.flushed_urls = 0
+
+    def __len__(self):
+        return len(self.coverage)
+
+    def __contains__(self, filename):
+        return self.files.ids.get(filename) in self.coverage
+
+    def __getitem__(self, filename):
+        return self.coverage[self.files.ids[filename]]
+
+    def keys(self):
+        return [self.files[file_id] for file_id in self.coverage]
+
+    def add(self, filename, lines, query):
+        if not lines:
+            return
+        file_id = self.files.intern(filename)
+        if file_id not in self.coverage:
+            self.coverage[file_id] = FileCoverage()
+        url = None if self.lines_only else self.urls.intern(query)
+        self.coverage[file_id].add(sorted(lines), url)
+
+    def nbytes(self):
+        return sum(f.nbytes() for f in self.coverage.values())
+
+    def detach(self):
+        """Moves coverage added since the last call to a new store and returns it.
+
+        The new store shares the string tables, `new_files` and `new_urls`
+        list (id, string) interned since the last call.
+        """
+        delta = CoverageStore(self.lines_only)
+        delta.files, delta.urls = self.files, self.urls
+        delta.coverage, self.coverage = self.coverage, {}
+        delta.new_files = list(enumerate(self.files.strings[self.flushed_files:], self.flushed_files))
+        delta.new_urls = list(enumerate(self.urls.strings[self.flushed_urls:], self.flushed_urls))
+        self.flushed_files, self.flushed_urls = len(self.files), len(self.urls)
+        return delta
+
+    def to_dict(self, queries=True):
+        """Coverage as {filename: {line: hits}}, or {filename: {line: [query, ...]}}
+        when queries were collected and asked for."""
+        result = {}
+        for file_id, data in self.coverage.items():
+            if queries and not self.lines_only:
+                lines = defaultdict(list)
+                for url, covered in data.records():
+                    for line in covered:
+                        lines[int(line)].append(self.urls[url])
+                result[self.files[file_id]] = dict(lines)
+            else:
+                result[self.files[file_id]] = dict((line, int(count)) for line, count in enumerate(data.hits) if count)
+        return result
+
+
+DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS urls (id INTEGER PRIMARY KEY, query TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS lines (
+    file_id INTEGER NOT NULL, line INTEGER NOT NULL, hits INTEGER NOT NULL,
+    PRIMARY KEY (file_id, line)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS line_sets (
+    id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, digest BLOB NOT NULL, lines BLOB NOT NULL,
+    UNIQUE (file_id, digest)
+);
+CREATE TABLE IF NOT EXISTS reports (
+    file_id INTEGER NOT NULL, url_id INTEGER NOT NULL, set_id INTEGER NOT NULL,
+    PRIMARY KEY (file_id, url_id, set_id)
+) WITHOUT ROWID;
+"""
+
+
+class CoverageDatabase(object):
+    """Coverage persisted to SQLite in WAL mode.
+
+    The collector writes detached CoverageStore batches with write(), hits
+    are added up and every report is kept as (file, url, set of lines) with
+    distinct sets of lines stored once. Files and urls keep the ids they
+    have in the store, so the store has to be loaded with load() before it
+    writes to an existing database. The database can be passed to
+    generate_report as is, it reads coverage of one file at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(DATABASE_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def load(self, store):
+        """Interns files and urls of the database in the store with the same ids."""
+        for table, strings in (('files', store.files), ('urls', store.urls)):
+            for id, string in self.conn.execute("SELECT * FROM %s ORDER BY id" % table):
+                if id != strings.intern(string):
+                    raise ValueError("%s already has strings not in %s" % (table, self.path))
+        store.flushed_files, store.flushed_urls = len(store.files), len(store.urls)
+
+    def write(self, delta):
+        with self.conn:
+            self.conn.executemany("INSERT INTO files (id, name) VALUES (?, ?)", delta.new_files)
+            self.conn.executemany("INSERT INTO urls (id, query) VALUES (?, ?)", delta.new_urls)
+            for file_id, data in delta.coverage.items():
+                self.conn.executemany(
+                    "INSERT INTO lines (file_id, line, hits) VALUES (?, ?, ?) "
+                    "ON CONFLICT (file_id, line) DO UPDATE SET hits = hits + excluded.hits",
+                    ((file_id, line, count) for line, count in enumerate(data.hits) if count))
+                if not data.urls:
+                    continue
+                sets = [self.line_set(file_id, packed) for packed in data.lines]
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO reports (file_id, url_id, set_id) VALUES (?, ?, ?)",
+                    ((file_id, url, sets[set_id]) for url, set_id in zip(data.urls, data.sets)))
+
+    def line_set(self, file_id, packed):
+        digest = buffer(md5(packed).digest())
+        self.conn.execute("INSERT OR IGNORE INTO line_sets (file_id, digest, lines) VALUES (?, ?, ?)",
+                          (file_id, digest, buffer(packed)))
+        return self.conn.execute("SELECT id FROM line_sets WHERE file_id = ? AND digest = ?",
+                                 (file_id, digest)).fetchone()[0]
+
+    def keys(self):
+        return [name for name, in self.conn.execute(
+            "SELECT name FROM files WHERE id IN (SELECT DISTINCT file_id FROM lines)")]
+
+    def __getitem__(self, filename):
+        return dict(self.conn.execute(
+            "SELECT line, hits FROM lines WHERE file_id = (SELECT id FROM files WHERE name = ?)", (filename,)))
+
+    def queries(self, filename):
+        """{line: [query, ...]} of a file."""
+        lines = defaultdict(list)
+        for query, packed in self.conn.execute(
+                "SELECT u.query, s.lines FROM reports r JOIN urls u ON u.id = r.url_id "
+                "JOIN line_sets s ON s.id = r.set_id WHERE r.file_id = (SELECT id FROM files WHERE name = ?)",
+                (filename,)):
+            covered = array('I')
+            covered.fromstring(str(packed))
+            for line in covered:
+                lines[int(line)].append(query)
+        return dict(lines)
+
+    def to_dict(self, queries=False):
+        if queries:
+            return dict((filename, self.queries(filename)) for filename in self.keys())
+        return dict((filename, self[filename]) for filename in self.keys())
@@ -1,4 +1,3 @@
-#!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
 # Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
@@ -15,54 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from optparse import OptionParser
-import urllib2
-from urllib import urlencode
-import datetime
-import time
-import zlib
-import sys
-import re
-import os
-from urllib2 import HTTPError
+"""Templates of the HTML report."""
 
-from collections import defaultdict
-
-from StringIO import StringIO
-import gzip
-
-import ujson
-import gevent
-from gevent.monkey import patch_all
-from gevent.pool import Pool
-from gevent.server import DatagramServer
-
-patch_all()
-
-from hashlib import md5
-
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import HtmlFormatter
-
-
-class CodeHtmlFormatter(HtmlFormatter):
-    def _highlight_lines(self, tokensource):
-        hls = self.hl_lines
-        line = """
+ROW = """
           <tr%s>
             <td class="line">%d</td>
             <td class="hits"></td>
             <td class="source">%s</td>
           </tr>
         """
-        for i, (t, value) in enumerate(tokensource):
-            if t != 1:
-                yield t, line % ('', i + 1, value)
-            if i + 1 in hls:  # i + 1 because Python indexes start at 0
-                yield 1, line % (' class="highlight"', i + 1, value)
-            else:
-                yield 1, line % ('', i + 1, value)
+
 
 HEADER = u"""
 <!DOCTYPE html>
@@ -455,6 +416,7 @@ HEADER = u"""
 </head>
 """
 
+
 HTML = """
 <body>
 <div id="coverage">
@@ -480,25 +442,28 @@ HTML = """
 </html>
 """
 
+
 MENU_FILE = """
         <li>
             <span class="cov high">%(percentage)3.0f</span>
-            <a href="#%(file_id)s">
+            <a href="%(href)s">
                 <span class="basename">%(basename)s</span>
             </a>
         </li>
 """
 
+
 MENU_DIR = """
         <li>
             <span class="cov high">%(percentage)3.0f</span>
-            <a href="#%(file_id)s">
+            <a href="%(href)s">
                 <span class="dirname">%(dirname)s</span>
                 <span class="basename">%(basename)s</span>
             </a>
         </li>
 """
 
+
 FILE = """
         <div class="file">
             <h2 id="%(file_id)s">%(filename)s</h2>
@@ -518,290 +483,14 @@ FILE = """
 """
 
 
-def generate_report(coverage=None, output='report.html'):
-    lexer = get_lexer_by_name("php", stripall=True, encoding="utf-8")
-
-    if not coverage:
-        with open('/tmp/walker.json', 'r') as f:
-            coverage = ujson.decode(f.read())
-
-    prefix = os.path.commonprefix(coverage.keys())
-    menu = []
-    code = []
-    sum_sloc = 0
-    sum_hits = 0
-
-    for filename in sorted(coverage.keys(), reverse=True):
-        try:
-            source = open(filename).read()
-        except OSError, e:
-            print e
-            continue
-        sloc = len(source.split('\n'))
-        sum_sloc = sum_sloc + sloc
-        file_id = md5(filename).hexdigest()
-        lines_cov = sorted([int(str(l)) for l in coverage[filename].keys()])
-        hits = len(lines_cov)
-        sum_hits = sum_hits + hits
-        formatter = CodeHtmlFormatter(linenos=True, hl_lines=lines_cov, nowrap=True, encoding="utf-8")
-
-        result = {
-            'table': highlight(source, lexer, formatter).decode("utf-8"),
-            'file_id': file_id,
-            'filename': filename.replace(prefix, ''),
-            'basename': os.path.basename(filename),
-            'dirname': os.path.dirname(filename.replace(prefix, '')),
-            'sloc': sloc,
-            'hits': hits,
-            'misses': sloc - hits,
-            'percentage': (float(hits) / float(sloc)) * 100.0
-        }
-
-        if result['basename'] != result['filename']:
-            menu.append(MENU_DIR % result)
-        else:
-            menu.append(MENU_FILE % result)
-        code.append(FILE % result)
-
-    report = HTML % {
-        'files': '\n\n'.join(code),
-        'menu': '\n\n'.join(menu),
-        'title': "Coverage for %s" % prefix,
-        'sloc': sum_sloc,
-        'hits': sum_hits,
-        'misses': sum_sloc - sum_hits,
-        'percentage': (float(sum_hits) / float(sum_sloc)) * 100.0
-    }
-
-    with open(output, 'w+') as f:
-        f.write(HEADER.encode("utf-8", 'ignore') + report.encode("utf-8", 'ignore'))
-        f.close()
-
-
-def html_escape(text):
-    """Produce entities within text."""
-    html_escape_table = {"&": "&amp;", '"': "&quot;", "'": "&apos;", ">": "&gt;", "<": "&lt;", "\t": "    "}
-    return "".join(html_escape_table.get(c, c) for c in text)
-
-
-class NoneContext(object):
-    def __enter__(self):
-        return None
-
-    def __exit__(self, exc, value, traceback):
-        return True
-
-
-class ResponseError(Exception):
-    pass
-
-
-class HttpResponse(object):
-    url = None
-    code = None
-    data = None
-    catch_response = False
-    allow_http_error = False
-    _trigger_success = None
-    _trigger_failure = None
-
-    def __init__(self, method, url, name, code, data, info, gzip):
-        self.method = method
-        self.url = url
-        self._name = name
-        self.code = code
-        self.data = data
-        self._info = info
-        self._gzip = gzip
-        self._decoded = False
-
-    @property
-    def info(self):
-        return self._info()
-
-    def _get_data(self):
-        if self._gzip and not self._decoded and self._info().get("Content-Encoding") == "gzip":
-            self._data = gzip.GzipFile(fileobj=StringIO(self._data)).read()
-            self._decoded = True
-        return self._data
-
-    def _set_data(self, data):
-        self._data = data
-
-    def __enter__(self):
-        if not self.catch_response:
-            raise ResponseError("If using response in a with() statement you must use catch_response=True")
-        return self
-
-    def __exit__(self, exc, value, traceback):
-        if exc:
-            if isinstance(value, ResponseError):
-                self._trigger_failure(value)
-            else:
-                raise value
-        else:
-            self._trigger_success()
-        return True
-
-    data = property(_get_data, _set_data)
-
-
-class HttpBrowser(object):
-    def __init__(self, base_url, gzip=False):
-        self.base_url = base_url
-        self.gzip = gzip
-        handlers = [urllib2.HTTPCookieProcessor()]
-        self.opener = urllib2.build_opener(*handlers)
-        urllib2.install_opener(self.opener)
-
-    def request(self, method, path, data=None, headers={}, name=None):
-        if self.gzip:
-            headers["Accept-Encoding"] = "gzip"
-
-        if data is not None:
-            try:
-                data = urlencode(data)
-            except TypeError:
-                pass  # ignore if someone sends in an already prepared string
-
-        url = self.base_url + path
-        request = urllib2.Request(url, data, headers)
-        request.get_method = lambda: method
-        try:
-            f = self.opener.open(request)
-            data = f.read()
-            f.close()
-        except HTTPError, e:
-            data = e.read()
-            e.locust_http_response = HttpResponse(method, url, name, e.code, data, e.info, self.gzip)
-            e.close()
-            raise e
-
-        return HttpResponse(method, url, name, f.code, data, f.info, self.gzip)
-
-
-class CoverageServer(DatagramServer):
-    chunk = 0
-    data = ""
-    coverage = defaultdict(dict)
-    lines = False
-    path = None
-
-    def lines(self, only_line=False):
-        self.lines_only = only_line
-        return self
-
-    def path(self, path=False):
-        self.prefix = path
-        return self
-
-    def handle(self, data, address):
-        if len(data) == 8192:
-            self.chunk = self.chunk + 1
-            self.data = self.data + data
-            return
-        if self.chunk > 0:
-            data = self.data + data
-            self.chunk = 0
-            self.data = ""
-
-        try:
-            report = ujson.decode(zlib.decompress(data))
-        except OSError, e:
-            print e
-        """
-        'coverage' => $coverage,
-        'pinba' => Ngs_Debug::pinbaRaw()
-        """
+INDEX_DIR = """
+        <li>
+            <span class="cov high">%(percentage)3.0f</span>
+            <a href="%(href)s">%(dirname)s</a>
+        </li>
+"""
 
-        #request = "http://%s%s" % (report['server'], report['uri'])
-        query = "http://%s%s" % (report['server'], report['query'])
-        #pinba = report['pinba']
-        #group = report['group']
-
-        for filename, lines in report['coverage'].items():
-            filename = str(filename)
-            if self.prefix and self.prefix not in filename:
-                continue
-            if '/data/tmp/' in filename:  # skip templates
-                continue
-
-            for line in lines.keys():
-                self.process_line(filename, int(line), query)
-
-        #print "Got report for", request, query, group, pinba['request']['time']['human'], len(coverage)
-
-    def process_line(self, filename, lineno, query):
-        if line not in self.coverage[filename].keys():
-            self.coverage[filename][lineno] = 0 if self.lines else []
-
-        if self.lines:
-            self.coverage[filename][lineno] = self.coverage[filename][lineno] + 1
-        else:
-            self.coverage[filename][lineno].append(query)
-
-if __name__ == '__main__':
-    parser = OptionParser()
-    parser.add_option("-u", "--urls", dest="urls", help="path to urls file")
-    parser.add_option("-g", "--group", dest="group", help="code coverage group", default="walker")
-    parser.add_option("-r", "--regex", dest="regex", help="regex to match urls", default=None)
-    parser.add_option("-o", "--report", dest="report", help="file name for report")
-    parser.add_option("-l", "--lines", dest="lines", help="collect only lines, not count", action="store_true", default=False)
-    parser.add_option("-p", "--path", dest="path", help="path to collect coverage for", default=None)
-    parser.add_option("-v", "--verbose", dest="verbose", help="verbose output", action="store_true", default=False)
-    (options, args) = parser.parse_args()
-
-    host = "127.0.0.1"
-    port = 5555
-
-    if not options.urls:
-        sys.stderr.write("No urls file specified!\n")
-        parser.print_usage()
-        sys.exit(1)
-
-    if not options.report:
-        sys.stderr.write("No report filename specified!\n")
-        parser.print_usage()
-        sys.exit(1)
-
-    client = HttpBrowser('', True)
-    headers = {'X-Walker': 'yes', 'X-Walker-Group': options.group, 'X-Walker-Host': host, 'X-Walker-Port': port}
-    if options.regex:
-        regex = re.compile(options.regex)
-        urls = [line.rstrip() for line in open(options.urls) if re.search(options.regex, line)]
-        print len(urls), "urls in file", options.urls, "matched by regex", options.regex
-    else:
-        urls = [line.rstrip() for line in open(options.urls)]
-        print len(urls), "urls in file", options.urls
-
-    def walker(urls, client, headers, server):
-        idx = 0
-        for url in urls:
-            t = time.time()
-            idx = idx + 1
-            url = url.replace(".ru", ".ru.mm.t0")
-            progress = "%04d/%04d" % (idx, len(urls))
-            result = client.request('GET', url, headers=headers)  # , allow_http_error=True)
-            if not result:
-                print progress, 'result is none!', url
-            else:
-                print progress, "%3.3f %d %d: %s" % (time.time() - t, result.code, len(result.data), url)
-        server.stop()
-
-    pool = Pool(100)
-    server = CoverageServer("%s:%d" % (host, int(port)), spawn=pool)
-    server.lines(options.lines).path(options.path)
-    print "Start at", datetime.datetime.now()
-    t = time.time()
-    try:
-        gevent.spawn(walker, urls, client, headers, server)
-        server.serve_forever()
-    except KeyboardInterrupt:
-        server.stop()
-    except Exception, e:
-        print e
-
-    print "Stop walking at", datetime.datetime.now(), "walk for %3.4fsec" % (time.time() - t)
-    generate_report(server.coverage, options.report)
-    print "Report saved to %s" % options.report
-    print "Bye, bye!"
+
+INDEX_LINK = """
+        <li><a href="../index.html">index</a></li>
+"""
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Oleg Fedoseev <oleg.fedoseev@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Urls to walk and the scheduler walking them."""
+
+import bisect
+import gzip
+import itertools
+import os
+import re
+import struct
+import sys
+import time
+from collections import defaultdict
+from hashlib import md5
+from urllib2 import HTTPError
+from urlparse import urlparse
+
+import gevent
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
+from gevent.queue import Queue
+
+
+# Url rewrites applied unless --rewrite or --no-rewrite is given.
+DEFAULT_REWRITES = ['.ru=.ru.mm.t0']
+
+
+class UrlSource(object):
+    """Lazily read urls from a plain or gzip compressed file, or stdin for '-'.
+
+    Every url goes through the stages in the order they were added. A stage
+    returns the url, possibly rewritten, or None to skip it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = []
+        self.lines = None
+
+    def stage(self, func):
+        self.stages.append(func)
+        return self
+
+    def include(self, pattern):
+        regex = re.compile(pattern)
+        return self.stage(lambda url: url if regex.search(url) else None)
+
+    def exclude(self, pattern):
+        regex = re.compile(pattern)
+        return self.stage(lambda url: None if regex.search(url) else url)
+
+    def rewrite(self, old, new):
+        return self.stage(lambda url: url.replace(old, new))
+
+    def shard(self, index, count, by='hash'):
+        """Keeps shard `index` of `count`, the urls whose fingerprint or line
+        number modulo `count` is `index`. Every node walking the same file
+        gets a different part of it."""
+        if by == 'index':
+            self.lines = (index, count)
+            return self
+        return self.stage(lambda url: url if url_key(url) % count == index else None)
+
+    def open(self):
+        if self.path == '-':
+            return read_lines(sys.stdin.fileno())
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, 'rb')
+        return open(self.path, 'rb')
+
+    def __iter__(self):
+        f = self.open()
+        try:
+            for number, line in enumerate(f):
+                if self.lines is not None and number % self.lines[1] != self.lines[0]:
+                    continue
+                url = line.strip()
+                if not url:
+                    continue
+                for stage in self.stages:
+                    url = stage(url)
+                    if url is None:
+                        break
+                else:
+                    yield url
+        finally:
+            f.close()
+
+    def count(self):
+        """Number of urls that pass all stages, None when reading stdin."""
+        if self.path == '-':
+            return None
+        return sum(1 for url in self)
+
+
+def read_lines(fd, size=64 * 1024):
+    """Lines of a pipe read in the threadpool, waiting on a slow producer
+    must not block the hub."""
+    threadpool = gevent.get_hub().threadpool
+    rest = ''
+    while True:
+        data = threadpool.apply(os.read, (fd, size))
+        if not data:
+            break
+        lines = (rest + data).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def url_key(url):
+    """64 bit fingerprint of a url, cheaper to keep in a set than the url."""
+    return struct.unpack('<q', md5(url).digest()[:8])[0]
+
+
+class WalkJournal(object):
+    """Append-only record of walked urls.
+
+    The first line keeps the coverage group, then every walked url is a line
+    of url, status, latency and bytes separated by tabs, status 0 stands for
+    a connection error. Entries are buffered and written `batch` at a time.
+    """
+
+    def __init__(self, path, group=None, batch=1000):
+        self.path = path
+        self.batch = batch
+        self.buffer = []
+        self.group = group
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f:
+                header = f.readline()
+            if header.startswith('# group='):
+                self.group = header[len('# group='):].rstrip('\n')
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'ab')
+            self.file.write('# group=%s\n' % group)
+
+    def add(self, url, status, latency, size):
+        self.buffer.append("%s\t%d\t%.3f\t%d\n" % (url, status, latency, size))
+        if len(self.buffer) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.file.flush()
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def walked(self, retry_errors=True):
+        """Set of url_key() of urls in the journal."""
+        self.flush()
+        keys = set()
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.split('\t', 2)
+                if len(fields) < 3 or (retry_errors and fields[1] == '0'):
+                    continue
+                keys.add(url_key(fields[0]))
+        return keys
+
+
+# Upper bounds of request latency histogram buckets in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+NUMBERS = re.compile(r'\d+')
+
+
+def url_pattern(url):
+    """Host and path of a url with numbers replaced by N."""
+    try:
+        parts = urlparse(url)
+    except ValueError:
+        return 'other'
+    return parts.netloc + NUMBERS.sub('N', parts.path)
+
+
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        self.counts[i] = self.counts[i] + 1
+        self.sum = self.sum + value
+
+    def buckets(self):
+        """(upper bound, cumulative count) like Prometheus, the last bound is +Inf."""
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total = total + count
+            yield bound, total
+
+
+class PatternStats(object):
+    __slots__ = ('codes', 'errors', 'bytes', 'latency')
+
+    def __init__(self):
+        self.codes = defaultdict(int)
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+
+class WalkStats(object):
+    """Walk totals, and per url pattern status codes, bytes and latency.
+
+    Past `max_patterns` patterns requests are counted as 'other'.
+    """
+
+    max_patterns = 1000
+
+    def __init__(self, total=None):
+        self.total = total
+        self.started = time.time()
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.latency = 0.0
+        self.codes = defaultdict(int)
+        self.patterns = {}
+
+    def pattern(self, url):
+        pattern = url_pattern(url) if url is not None else 'other'
+        stats = self.patterns.get(pattern)
+        if stats is None:
+            if len(self.patterns) >= self.max_patterns:
+                pattern = 'other'
+            stats = self.patterns.get(pattern)
+            if stats is None:
+                stats = self.patterns[pattern] = PatternStats()
+        return stats
+
+    def add(self, code, size, latency, url=None):
+        self.done = self.done + 1
+        self.bytes = self.bytes + size
+        self.latency = self.latency + latency
+        self.codes[code] = self.codes[code] + 1
+        stats = self.pattern(url)
+        stats.codes[code] = stats.codes[code] + 1
+        stats.bytes = stats.bytes + size
+        stats.latency.observe(latency)
+
+    def error(self, latency, url=None):
+        self.done = self.done + 1
+        self.failed = self.failed + 1
+        self.latency = self.latency + latency
+        stats = self.pattern(url)
+        stats.errors = stats.errors + 1
+        stats.latency.observe(latency)
+
+    def progress(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        total = "%d" % self.total if self.total is not None else "?"
+        codes = " ".join("%s:%d" % (code, count) for code, count in sorted(self.codes.items()))
+        return "%d/%s done, %d failed, %.1f req/s, avg %3.3fs, %d bytes [%s]" % (
+            self.done, total, self.failed, self.done / elapsed,
+            self.latency / max(self.done, 1), self.bytes, codes)
+
+
+class ReportTracker(object):
+    """Urls of walked requests whose coverage report hasn't arrived yet.
+
+    Every request gets a unique X-Walker-Id before it is sent, PHP echoes it
+    as 'id' in its report and the collector passes it to reported().
+    """
+
+    def __init__(self):
+        self.prefix = os.urandom(4).encode('hex')
+        self.counter = itertools.count(1)
+        self.outstanding = {}
+        self.empty = Event()
+        self.empty.set()
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def add(self, url):
+        id = '%s-%d' % (self.prefix, next(self.counter))
+        self.outstanding[id] = url
+        self.empty.clear()
+        return id
+
+    def reported(self, id):
+        """Report of `id` arrived, or no report will, ids of other walks are ignored."""
+        if self.outstanding.pop(id, None) is not None and not self.outstanding:
+            self.empty.set()
+
+    def drain(self, timeout):
+        """Waits up to `timeout` seconds for outstanding reports and returns
+        urls of the ones still missing."""
+        self.empty.wait(timeout)
+        return sorted(self.outstanding.values())
+
+
+class WalkScheduler(object):
+    """Walk urls with a fixed number of worker greenlets.
+
+    `concurrency` workers pull urls from a shared bounded queue, so it is
+    also the global limit of requests in flight. `per_host` caps requests
+    in flight to a single host and `rps` spaces out requests so the walk
+    never goes above the given rate.
+    """
+
+    def __init__(self, client, headers, concurrency=10, per_host=0, rps=0, interval=10.0, verbose=False):
+        self.client = client
+        self.headers = headers
+        self.concurrency = max(int(concurrency), 1)
+        self.per_host = per_host
+        self.rps = rps
+        self.interval = interval
+        self.verbose = verbose
+        self.queue = Queue(self.concurrency * 2)
+        self.hosts = defaultdict(lambda: BoundedSemaphore(self.per_host))
+        self.stats = WalkStats()
+        self.status = None
+        self.journal = None
+        self.tracker = None
+        self.workers = []
+        self.reporter = None
+        self._next_slot = 0.0
+
+    def throttle(self):
+        if not self.rps:
+            return
+        now = time.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1.0 / self.rps
+        if slot > now:
+            gevent.sleep(slot - now)
+
+    def fetch(self, url):
+        self.throttle()
+        headers = dict(self.headers)
+        if self.tracker is not None:
+            headers['X-Walker-Id'] = self.tracker.add(url)
+        t = time.time()
+        try:
+            result = self.client.request('GET', url, headers=headers, stream=True)
+        except HTTPError, e:
+            result = e.locust_http_response
+        except Exception, e:
+            # a bad url must not kill the worker and leave its id outstanding
+            if self.tracker is not None:
+                self.tracker.reported(headers['X-Walker-Id'])
+            self.stats.error(time.time() - t, url)
+            if self.journal is not None:
+                self.journal.add(url, 0, time.time() - t, 0)
+            if self.verbose:
+                print "%3.3f error %s: %s" % (time.time() - t, e, url)
+            return
+        self.stats.add(result.code, result.size, time.time() - t, url)
+        if self.journal is not None:
+            self.journal.add(url, result.code, time.time() - t, result.size)
+        if self.verbose:
+            print "%3.3f %d %d: %s" % (time.time() - t, result.code, result.size, url)
+
+    def worker(self):
+        for url in self.queue:
+            if self.per_host:
+                try:
+                    host = urlparse(url).netloc
+                except ValueError:
+                    host = None
+                with self.hosts[host]:
+                    self.fetch(url)
+            else:
+                self.fetch(url)
+
+    def report(self):
+        while True:
+            gevent.sleep(self.interval)
+            print self.stats.progress()
+            if self.status is not None:
+                print self.status()
+
+    def run(self, urls, total=None):
+        if total is not None:
+            self.stats.total = total
+        self.workers = [gevent.spawn(self.worker) for i in xrange(self.concurrency)]
+        self.reporter = gevent.spawn(self.report)
+        for url in urls:
+            self.queue.put(url)
+        for worker in self.workers:
+            self.queue.put(StopIteration)
+        gevent.joinall(self.workers)
+        self.reporter.kill()
+        print self.stats.progress()
+        return self.stats
+
+    def stop(self):
+        """Kills the workers and the progress reporter, requests in flight
+        are dropped."""
+        gevent.killall(self.workers)
+        if self.reporter is not None:
+            self.reporter.kill()